@@ -1,56 +1,34 @@
 # app_full.py
 # -*- coding: utf-8 -*-
-import os, sqlite3
+import os, sys, sqlite3, threading, time, multiprocessing, zipfile
+import base64, csv, hashlib, io, json, mimetypes, shutil, tempfile
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Optional
 import secrets
 from datetime import datetime
 from functools import wraps
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from flask import (
-    Flask, render_template_string, request, redirect,
-    url_for, send_file, flash, session, send_from_directory
+    Flask, render_template, request, redirect,
+    url_for, send_file, flash, session,
+    Response, stream_with_context
 )
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
-import pandas as pd
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.utils import secure_filename, send_file as werkzeug_send_file
+from jinja2 import ChoiceLoader, DictLoader, FileSystemBytecodeCache
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from PIL import Image as PILImage, ImageOps, features as pil_features
 from reportlab.lib import colors
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import mm
-
-from reportlab.pdfgen import canvas
-from reportlab.lib.units import mm
-
-class NumberedCanvas(canvas.Canvas):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._saved_page_states = []
-
-    def showPage(self):
-        # เก็บสภาพของหน้าปัจจุบันไว้ก่อนเปลี่ยนหน้า
-        self._saved_page_states.append(dict(self.__dict__))
-        self._startPage()  # ใช้ _startPage เพื่อไม่ให้เลขหน้าถูกวาดซ้ำ
-
-    def save(self):
-        # วาดเลขหน้าท้ายสุดทุกหน้า แล้วค่อยบันทึก
-        num_pages = len(self._saved_page_states)
-        for state in self._saved_page_states:
-            self.__dict__.update(state)
-            self._draw_page_number(num_pages)
-            super().showPage()
-        super().save()
-
-    def _draw_page_number(self, page_count):
-        page = self._pageNumber
-        # ฟอนต์ไทยมี/ไม่มี ก็ไม่ให้ล้ม
-        try:
-            self.setFont("THSarabunNew", 12)
-        except Exception:
-            self.setFont("Helvetica", 10)
-        self.drawRightString(200*mm, 10*mm, f"{page}/{page_count}")
+from reportlab.platypus import Paragraph, Spacer
+from pdf_reports import (
+    NumberedCanvas, ChunkedTable, get_pdf_resources, pdf_document, pdf_header_elements,
+    pdf_signature_elements, render_inspection_sheet,
+)
 
 
 # -------------------- App --------------------
@@ -64,29 +42,64 @@ app.secret_key = "supersecretkey"
 BASE_DIR    = os.path.join(os.path.expanduser("~"), "Yui_App_DB")
 DB_NAME     = os.path.join(BASE_DIR, "records.db")
 UPLOAD_DIR  = os.path.join(BASE_DIR, "uploads")
+EXPORT_DIR  = os.path.join(BASE_DIR, "exports")
+THUMB_DIR   = os.path.join(BASE_DIR, "thumbs")
 os.makedirs(BASE_DIR, exist_ok=True)
+UPLOAD_TMP_DIR = os.path.join(UPLOAD_DIR, "tmp")   # ไฟล์ระหว่างอัปโหลด (อยู่ใน filesystem เดียวกัน → os.replace ได้)
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+os.makedirs(EXPORT_DIR, exist_ok=True)
+os.makedirs(THUMB_DIR, exist_ok=True)
 
 ALLOWED_EXTS = {"png","jpg","jpeg","gif","pdf","doc","docx","xls","xlsx","csv","txt"}
 
+# -------------------- Templates --------------------
+# template ในไฟล์นี้ลงทะเบียนเข้า DictLoader → Jinja compile ครั้งเดียวต่อ worker แล้ว cache ไว้
+# (เดิม render_template_string ต้อง parse/compile ใหม่ทุก request)
+INLINE_TEMPLATES = {}
+JINJA_CACHE_DIR = os.path.join(BASE_DIR, "jinja_cache")
+
+def register_template(name, source):
+    INLINE_TEMPLATES[name] = source
+    return name
+
 
 import traceback, logging
 logging.basicConfig(level=logging.INFO)
 
-@app.errorhandler(500)
-def handle_500(e):
-    return render_template_string("""
+register_template("error_500.html", """
     <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css" rel="stylesheet">
     <div class="container mt-4">
       <div class="alert alert-danger">เกิดข้อผิดพลาดภายในระบบ — โปรดดู Logs/Console เพื่อรายละเอียด</div>
       <a class="btn btn-secondary" href="{{url_for('index')}}">กลับหน้าหลัก</a>
     </div>
-    """), 500
+    """)
+
+@app.errorhandler(500)
+def handle_500(e):
+    return render_template("error_500.html"), 500
 
 # === SUPER DEBUG (ใช้เฉพาะชั่วคราวเพื่อจับต้นเหตุ) ===
 import traceback, logging
 logging.basicConfig(level=logging.INFO)
 
+register_template("error_admin.html", """{% include "theme.html" %}
+        <div class="container-narrow mt-4">
+          <div class="alert alert-danger"><b>เกิดข้อผิดพลาด:</b> {{ error_type }}: {{ error }}</div>
+          <pre style="white-space: pre-wrap; background:#111; color:#0f0; padding:12px; border-radius:8px; max-height:50vh; overflow:auto;">{{ tb }}</pre>
+          <a class="btn btn-secondary mt-2" href="{{url_for('index')}}">กลับหน้าหลัก</a>
+        </div>
+        """)
+
+register_template("error.html", """{% include "theme.html" %}
+    <div class="container-narrow mt-4">
+      <div class="alert alert-danger">
+        เกิดข้อผิดพลาดภายในระบบ — โปรดติดต่อผู้ดูแลระบบ
+      </div>
+      <a class="btn btn-secondary" href="{{url_for('index')}}">กลับหน้าหลัก</a>
+    </div>
+    """)
+
 @app.errorhandler(Exception)
 def handle_any_exception(e):
     # Log เต็ม ๆ ไปที่ console / Render logs
@@ -95,23 +108,10 @@ def handle_any_exception(e):
     # ถ้าผู้ใช้เป็น admin ให้โชว์ stack trace บนหน้าเลย (เฉพาะชั่วคราว)
     if session.get("role") == "admin":
         tb = "".join(traceback.format_exception(type(e), e, e.__traceback__))
-        return render_template_string(THEME_CSS + f"""
-        <div class="container-narrow mt-4">
-          <div class="alert alert-danger"><b>เกิดข้อผิดพลาด:</b> {type(e).__name__}: {str(e)}</div>
-          <pre style="white-space: pre-wrap; background:#111; color:#0f0; padding:12px; border-radius:8px; max-height:50vh; overflow:auto;">{tb}</pre>
-          <a class="btn btn-secondary mt-2" href="{{{{url_for('index')}}}}">กลับหน้าหลัก</a>
-        </div>
-        """), 500
+        return render_template("error_admin.html", error_type=type(e).__name__, error=str(e), tb=tb), 500
 
     # ถ้าไม่ใช่ admin แสดงข้อความสุภาพ
-    return render_template_string(THEME_CSS + """
-    <div class="container-narrow mt-4">
-      <div class="alert alert-danger">
-        เกิดข้อผิดพลาดภายในระบบ — โปรดติดต่อผู้ดูแลระบบ
-      </div>
-      <a class="btn btn-secondary" href="{{url_for('index')}}">กลับหน้าหลัก</a>
-    </div>
-    """), 500
+    return render_template("error.html"), 500
 
 
 # -------------------- Helpers --------------------
@@ -125,6 +125,23 @@ def parse_thai_date_to_iso(date_str: str) -> str:
     return datetime.strptime(date_str, "%d/%m/%Y").strftime("%Y-%m-%d")
 
 
+def page_window(page, total_pages, radius=2):
+    """
+    เลขหน้าที่จะแสดงใน pagination: หน้าแรก, หน้าสุดท้าย และ ±radius รอบหน้าปัจจุบัน
+    ช่วงที่ข้ามไปจะเป็น None (แสดงเป็น …) เช่น [1, None, 8, 9, 10, 11, 12, None, 40]
+    """
+    if total_pages <= 0:
+        return []
+    shown = {1, total_pages} | set(range(max(1, page - radius), min(total_pages, page + radius) + 1))
+    links, prev = [], 0
+    for p in sorted(shown):
+        if p - prev > 1:
+            links.append(None)
+        links.append(p)
+        prev = p
+    return links
+
+
 def login_required(view):
     @wraps(view)
     def wrapped(*args, **kwargs):
@@ -138,27 +155,720 @@ def allowed_file(filename: str) -> bool:
     return "." in filename and filename.rsplit(".",1)[1].lower() in ALLOWED_EXTS
 
 # -------------------- Database --------------------
+# PRAGMA ที่ใช้กับทุก connection (WAL ให้อ่าน/เขียนพร้อมกันได้, busy_timeout กัน "database is locked")
+DB_BUSY_TIMEOUT_MS = 5000
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}",
+    "PRAGMA cache_size=-16000",       # ~16 MB page cache ต่อ connection
+    "PRAGMA mmap_size=134217728",     # 128 MB memory-mapped I/O
+    "PRAGMA temp_store=MEMORY",
+)
+
+_db_local = threading.local()
+
+def _db_file_id():
+    """(st_dev, st_ino) ของไฟล์ DB ตอนนี้ — restore สลับไฟล์ใหม่เข้ามาแทน → ค่าเปลี่ยน (ทุก process เห็นเหมือนกัน)"""
+    try:
+        st = os.stat(DB_NAME)
+    except FileNotFoundError:
+        return None   # อยู่ระหว่างสลับไฟล์ → ใช้ connection เดิมไปก่อน
+    return st.st_dev, st.st_ino
+
+def _connect(db_path=None):
+    conn = sqlite3.connect(db_path or DB_NAME, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def get_db():
+    """
+    คืน connection ที่ผูกกับ thread/worker ปัจจุบัน (เปิดครั้งเดียวแล้วใช้ซ้ำทุก request)
+    ใช้แบบเดิมได้เลย: `with get_db() as conn:` → commit/rollback อัตโนมัติ (ไม่ปิด connection)
+    """
+    conn = getattr(_db_local, "conn", None)
+    if conn is not None:
+        if _db_local.pid != os.getpid():
+            conn = None   # fork ใหม่ (gunicorn worker) → connection ของ parent ห้ามใช้/ห้ามปิด
+        elif not conn.in_transaction:
+            # ไฟล์ DB ถูกสลับ (restore จาก worker ไหนก็ได้) → ทิ้ง connection เดิม ไม่งั้นจะอ่าน/เขียนลงไฟล์ .bak_* ต่อ
+            # ระหว่าง transaction ห้ามสลับ (เช่นกลาง read_snapshot): ใช้ snapshot เดิมให้จบ แล้วค่อยเปิดใหม่ครั้งหน้า
+            file_id = _db_file_id()
+            if file_id is not None and file_id != _db_local.file_id:
+                try: conn.close()
+                except Exception: pass
+                conn = None
+    if conn is None:
+        file_id = _db_file_id()   # ก่อน connect: ถ้าสลับไฟล์ระหว่างนี้ ครั้งหน้าแค่เปิดใหม่อีกรอบ
+        conn = _connect()
+        _db_local.conn = conn
+        _db_local.pid = os.getpid()
+        _db_local.file_id = file_id
+    return conn
+
+def close_db():
+    conn = getattr(_db_local, "conn", None)
+    _db_local.conn = None
+    if conn is not None and _db_local.pid == os.getpid():
+        conn.close()
+
+def invalidate_db_pool():
+    """เรียกก่อนสลับไฟล์ DB: ปิด connection ของ thread นี้ (thread/process อื่นเห็น inode เปลี่ยนใน get_db() เอง)"""
+    close_db()
+
+def checkpoint_db():
+    """รวม WAL กลับเข้าไฟล์หลัก (ก่อน restore สลับไฟล์ให้ไฟล์ .db ครบในตัวเอง)"""
+    get_db().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+@app.teardown_appcontext
+def _release_db(exc):
+    # ไม่ปล่อย transaction ค้างข้าม request (กันล็อก DB ค้างไว้ให้คนอื่นรอ)
+    conn = getattr(_db_local, "conn", None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+# -------------------- Migrations --------------------
+# เวอร์ชัน schema เก็บใน PRAGMA user_version; เพิ่มขั้นตอนใหม่ต่อท้าย MIGRATIONS เท่านั้น (ห้ามแก้ของเดิม)
+def _migration_001_base_tables(c):
+    c.execute("""CREATE TABLE IF NOT EXISTS users(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE, password_hash TEXT, role TEXT)""")
+    c.execute("""CREATE TABLE IF NOT EXISTS records(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        machine_no TEXT, name TEXT,
+        date_text TEXT, date_iso TEXT,
+        comments TEXT, damage TEXT,
+        created_by TEXT, created_at_iso TEXT,
+        file_path TEXT)""")
+
+def _migration_002_records_indexes(c):
+    # filter ช่วงวันที่ / trend GROUP BY date_iso
+    c.execute("CREATE INDEX IF NOT EXISTS idx_records_date_iso ON records(date_iso)")
+    # sort_by=created (ค่า default ของหน้า index)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_records_created_at ON records(created_at_iso)")
+    # sort_by=machine + covering สำหรับ Top 10 รถ (GROUP BY machine_no กรองช่วงวันที่)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_records_machine_date ON records(machine_no, date_iso)")
+    # เฉพาะแถวที่มีความเสียหาย (damage_only / % รถที่พบปัญหา)
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_records_damaged ON records(date_iso, machine_no)
+                 WHERE damage IS NOT NULL AND damage <> ''""")
+    c.execute("ANALYZE records")
+
+def _migration_003_records_fts(c):
+    # SQLite ยังไม่มี trigram → ข้ามไปก่อน; init_db() ลองสร้างใหม่ทุกครั้งที่ start (เผื่อ SQLite ถูกอัปเกรดทีหลัง)
+    create_records_fts(c)
+
+def create_records_fts(c):
+    """สร้าง records_fts + trigger + back-fill; คืน False ถ้า SQLite ไม่รองรับ (ค้นหาใช้ LIKE แทน)"""
+    # FTS5 + trigram: ค้นหา substring ได้ทั้งภาษาไทย (ไม่มีเว้นวรรคระหว่างคำ) และอังกฤษ
+    try:
+        c.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS records_fts USING fts5(
+            machine_no, name, comments, damage,
+            content='records', content_rowid='id', tokenize='trigram')""")
+    except sqlite3.OperationalError as e:
+        # SQLite < 3.34 ไม่มี trigram → ข้ามไป ค้นหาจะ fallback เป็น LIKE
+        app.logger.warning("FTS5 trigram ไม่พร้อมใช้งาน (%s) → ใช้ LIKE แทน", e)
+        return False
+    c.execute("""CREATE TRIGGER IF NOT EXISTS records_fts_ai AFTER INSERT ON records BEGIN
+        INSERT INTO records_fts(rowid, machine_no, name, comments, damage)
+        VALUES (new.id, new.machine_no, new.name, new.comments, new.damage);
+    END""")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS records_fts_ad AFTER DELETE ON records BEGIN
+        INSERT INTO records_fts(records_fts, rowid, machine_no, name, comments, damage)
+        VALUES ('delete', old.id, old.machine_no, old.name, old.comments, old.damage);
+    END""")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS records_fts_au
+        AFTER UPDATE OF machine_no, name, comments, damage ON records BEGIN
+        INSERT INTO records_fts(records_fts, rowid, machine_no, name, comments, damage)
+        VALUES ('delete', old.id, old.machine_no, old.name, old.comments, old.damage);
+        INSERT INTO records_fts(rowid, machine_no, name, comments, damage)
+        VALUES (new.id, new.machine_no, new.name, new.comments, new.damage);
+    END""")
+    # back-fill แถวเดิมทั้งหมด
+    c.execute("INSERT INTO records_fts(records_fts) VALUES ('rebuild')")
+    return True
+
+def ensure_records_fts(conn):
+    """records_fts ยังไม่มี (migration 003 ข้ามไปตอน SQLite ยังเก่า) → ลองสร้างอีกครั้ง; คืนว่าใช้ FTS ได้ไหม"""
+    has_fts = "SELECT 1 FROM sqlite_master WHERE type='table' AND name='records_fts'"
+    if conn.execute(has_fts).fetchone():
+        return True
+    conn.execute("BEGIN IMMEDIATE")   # หลาย worker start พร้อมกัน → สร้าง/rebuild ทีละตัว
+    try:
+        ok = conn.execute(has_fts).fetchone() is not None or create_records_fts(conn.cursor())
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return ok
+
+def _migration_004_keyset_indexes(c):
+    # keyset pagination เรียงด้วย (คอลัมน์, id): index คอลัมน์เดียวมี rowid ต่อท้ายอยู่แล้ว
+    # date_iso / created_at_iso มีจาก 002; machine_no ต้องแยกจาก (machine_no, date_iso)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_records_machine_no ON records(machine_no)")
+
+def _migration_005_dashboard_rollups(c):
+    # ยอดรวมต่อวัน / ต่อรถต่อวัน สำหรับ dashboard (trigger อัปเดตทุก insert/update/delete)
+    c.execute("""CREATE TABLE IF NOT EXISTS records_daily(
+        date_iso TEXT PRIMARY KEY,
+        total INTEGER NOT NULL DEFAULT 0,
+        damaged INTEGER NOT NULL DEFAULT 0)""")
+    c.execute("""CREATE TABLE IF NOT EXISTS records_machine_daily(
+        machine_no TEXT NOT NULL,
+        date_iso TEXT NOT NULL,
+        total INTEGER NOT NULL DEFAULT 0,
+        damaged INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (machine_no, date_iso))""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_records_machine_daily_date ON records_machine_daily(date_iso)")
+    for sql in ROLLUP_TRIGGERS:
+        c.execute(sql)
+    rebuild_rollups(c)
+
+def _migration_006_damage_terms(c):
+    # คำใน damage (แยกด้วยช่องว่าง) หนึ่งแถวต่อหนึ่งครั้งที่พบ → Top 5 ปัญหา = GROUP BY term
+    c.execute("""CREATE TABLE IF NOT EXISTS damage_terms(
+        record_id INTEGER NOT NULL,
+        term TEXT NOT NULL)""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_damage_terms_term ON damage_terms(term, record_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_damage_terms_record ON damage_terms(record_id)")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS records_damage_terms_ad AFTER DELETE ON records BEGIN
+        DELETE FROM damage_terms WHERE record_id = old.id;
+    END""")
+    c.execute("DELETE FROM damage_terms")
+    for rec_id, damage in c.execute(
+            "SELECT id, damage FROM records WHERE damage IS NOT NULL AND damage <> ''").fetchall():
+        c.executemany("INSERT INTO damage_terms(record_id, term) VALUES (?, ?)",
+                      [(rec_id, t) for t in split_damage_terms(damage)])
+
+def _migration_007_data_version(c):
+    # ตัวนับเวอร์ชันข้อมูล (ทุก process เห็นค่าเดียวกัน) → ใช้เป็นส่วนหนึ่งของ key ของ query cache
+    c.execute("""CREATE TABLE IF NOT EXISTS app_meta(
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL)""")
+    c.execute("INSERT OR IGNORE INTO app_meta(key, value) VALUES ('data_version', 0)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        c.execute(f"""CREATE TRIGGER IF NOT EXISTS records_data_version_{event.lower()}
+            AFTER {event} ON records BEGIN
+            UPDATE app_meta SET value = value + 1 WHERE key = 'data_version';
+        END""")
+
+def _migration_008_export_jobs(c):
+    # งาน export เบื้องหลัง: ทุก worker process อ่านสถานะจากตารางเดียวกัน (ใครรับ request ก็ตอบได้)
+    c.execute("""CREATE TABLE IF NOT EXISTS export_jobs(
+        id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        params TEXT NOT NULL,
+        status TEXT NOT NULL,
+        progress INTEGER NOT NULL DEFAULT 0,
+        total INTEGER,
+        file_size INTEGER,
+        error TEXT,
+        created_by TEXT,
+        pid INTEGER,
+        created_at REAL NOT NULL,
+        finished_at REAL)""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_export_jobs_status ON export_jobs(status)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_export_jobs_created_at ON export_jobs(created_at)")
+
+def _migration_009_export_cache(c):
+    # cache_key: ไฟล์ export ที่ใช้ซ้ำได้ (format + filter + data_version); artifact: ชื่อไฟล์ใน EXPORT_DIR
+    c.execute("ALTER TABLE export_jobs ADD COLUMN cache_key TEXT")
+    c.execute("ALTER TABLE export_jobs ADD COLUMN artifact TEXT")
+
+def _migration_010_upload_blobs(c):
+    # ไฟล์แนบแบบ content-addressed: blobs = เนื้อหาไม่ซ้ำ (ตาม SHA-256), uploads = ชื่อใน records.file_path → blob
+    c.execute("""CREATE TABLE IF NOT EXISTS blobs(
+        sha256 TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        refcount INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT)""")
+    c.execute("""CREATE TABLE IF NOT EXISTS uploads(
+        stored_name TEXT PRIMARY KEY,
+        sha256 TEXT NOT NULL,
+        original_name TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        created_at TEXT)""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_uploads_sha256 ON uploads(sha256)")
+    # ไฟล์เดิมที่วางแบนอยู่ใน UPLOAD_DIR → hard link เข้า blob store (ชื่อใน file_path ใช้ต่อได้เหมือนเดิม)
+    # แล้วจด ชื่อ → sha256 ไว้ใน LEGACY_UPLOAD_MAP (นอก DB): ไฟล์แบนที่ถูก prune ไปแล้ว (flask prune-legacy-uploads)
+    # ยังหาเจอตอน restore backup ก่อน 010 แล้ว migration นี้รันซ้ำกับไฟล์ DB นั้น
+    legacy = load_legacy_map()
+    learned, seen = [], set()
+    for (file_path,) in c.execute(
+            "SELECT file_path FROM records WHERE file_path IS NOT NULL AND file_path <> ''").fetchall():
+        for name in file_path.split(";"):
+            if name in seen:
+                continue   # ชื่อเดียวกันหลาย record → ไฟล์เดียวกัน นับ blob ครั้งเดียว
+            seen.add(name)
+            path = safe_join(UPLOAD_DIR, name)
+            if path and os.path.isfile(path):
+                sha256, size = hash_file(path)
+                place_blob(path, sha256, keep_source=True)
+                if legacy.get(name) != (sha256, size):
+                    legacy[name] = (sha256, size)
+                    learned.append((name, sha256, size))
+            elif name in legacy and os.path.isfile(blob_path(legacy[name][0])):
+                sha256, size = legacy[name]
+            else:
+                continue   # ไฟล์หายไปก่อนแล้ว → /uploads/<name> ตอบ 404 เหมือนเดิม
+            c.execute("INSERT INTO uploads(stored_name, sha256, original_name, size, created_at) VALUES (?, ?, ?, ?, ?)",
+                      (name, sha256, name, size, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            add_blob_ref(c, sha256, size)
+    remember_legacy_uploads(learned)
+
+# จำนวน/ขนาดรวมของไฟล์แนบเก็บใน records → หน้า index / export / API ใช้ได้โดยไม่ JOIN และไม่แตะดิสก์
+ATTACHMENT_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS attachments_ai AFTER INSERT ON attachments BEGIN
+        UPDATE records SET attachment_count = attachment_count + 1,
+                           attachment_bytes = attachment_bytes + new.size
+         WHERE id = new.record_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS attachments_ad AFTER DELETE ON attachments BEGIN
+        UPDATE records SET attachment_count = attachment_count - 1,
+                           attachment_bytes = attachment_bytes - old.size
+         WHERE id = old.record_id;
+    END""",
+)
+
+def _migration_011_attachments(c):
+    # ไฟล์แนบหนึ่งแถวต่อไฟล์ แทน records.file_path ที่ต่อชื่อด้วย ';' (คอลัมน์เดิมคงไว้ให้ backup เก่า restore ได้)
+    c.execute("""CREATE TABLE IF NOT EXISTS attachments(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        record_id INTEGER NOT NULL,
+        stored_name TEXT NOT NULL UNIQUE,
+        original_name TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mime TEXT,
+        sha256 TEXT NOT NULL,
+        created_at TEXT)""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_attachments_record ON attachments(record_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_attachments_sha256 ON attachments(sha256)")
+    c.execute("ALTER TABLE records ADD COLUMN attachment_count INTEGER NOT NULL DEFAULT 0")
+    c.execute("ALTER TABLE records ADD COLUMN attachment_bytes INTEGER NOT NULL DEFAULT 0")
+    for sql in ATTACHMENT_TRIGGERS:
+        c.execute(sql)
+    # แปลงตามลำดับเดิมใน file_path; ชื่อที่ไม่มีใน uploads = หาไฟล์ไม่เจอ (เดิมก็เปิดไม่ได้)
+    # → คงไว้ใน file_path ตามเดิม ไม่ทิ้งการอ้างอิง (เผื่อหาไฟล์กลับมาได้ทีหลัง)
+    for rec_id, file_path in c.execute(
+            "SELECT id, file_path FROM records WHERE file_path IS NOT NULL AND file_path <> '' ORDER BY id").fetchall():
+        unresolved = []
+        for name in file_path.split(";"):
+            row = c.execute("SELECT sha256, original_name, size, created_at FROM uploads WHERE stored_name = ?",
+                            (name,)).fetchone()
+            if not row:
+                unresolved.append(name)
+                continue
+            sha256, original_name, size, created_at = row
+            owner = c.execute("SELECT record_id FROM attachments WHERE stored_name = ?", (name,)).fetchone()
+            if owner and owner[0] == rec_id:
+                continue   # ชื่อซ้ำใน record เดียวกัน
+            # ไฟล์เดิมชื่อเดียวกันถูกอ้างจากหลาย record (เนื้อหาเดียวกัน) → record หลัง ๆ ได้ stored_name ใหม่ที่ชี้ blob เดิม
+            stored_name = f"{secrets.token_hex(6)}_{name}" if owner else name
+            c.execute("""INSERT INTO attachments
+                         (record_id, stored_name, original_name, size, mime, sha256, created_at)
+                         VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                      (rec_id, stored_name, original_name, size, guess_mime(original_name), sha256, created_at))
+        c.execute("UPDATE records SET file_path = ? WHERE id = ?", (";".join(unresolved) or None, rec_id))
+    # refcount = จำนวน attachments ต่อ blob; ไฟล์ของ blob ที่ไม่เหลือใครใช้ → migrate_db ลบหลัง commit
+    c.execute("UPDATE blobs SET refcount = (SELECT COUNT(*) FROM attachments WHERE sha256 = blobs.sha256)")
+    orphans = [sha256 for (sha256,) in c.execute("SELECT sha256 FROM blobs WHERE refcount = 0").fetchall()]
+    c.execute("DELETE FROM blobs WHERE refcount = 0")
+    c.execute("DROP TABLE uploads")
+    return orphans
+
+def _migration_012_keyset_null_keys(c):
+    # keyset/ORDER BY ใช้ IFNULL(คอลัมน์, '') (ดู SORT_OPTIONS) → expression index; rowid ต่อท้ายให้เอง (ตัดสินด้วย id)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_records_created_key ON records(IFNULL(created_at_iso, ''))")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_records_date_key ON records(IFNULL(date_iso, ''))")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_records_machine_key ON records(IFNULL(machine_no, ''))")
+    c.execute("ANALYZE records")
+
+MIGRATIONS = [
+    _migration_001_base_tables,
+    _migration_002_records_indexes,
+    _migration_003_records_fts,
+    _migration_004_keyset_indexes,
+    _migration_005_dashboard_rollups,
+    _migration_006_damage_terms,
+    _migration_007_data_version,
+    _migration_008_export_jobs,
+    _migration_009_export_cache,
+    _migration_010_upload_blobs,
+    _migration_011_attachments,
+    _migration_012_keyset_null_keys,
+]
+
+def migrate_db(conn):
+    """
+    รัน migration ที่ยังไม่ได้รันตามลำดับ; แต่ละขั้นเป็น transaction ของตัวเอง
+    ขั้นที่ปลด blob คืน list sha256 → ลบไฟล์หลัง commit (rollback แล้วไฟล์ต้องยังอยู่)
+    """
+    for version, step in enumerate(MIGRATIONS, start=1):
+        # BEGIN IMMEDIATE: ถ้าหลาย worker start พร้อมกัน จะรันทีละตัว แล้วอ่าน version ใหม่หลังได้ล็อก
+        conn.execute("BEGIN IMMEDIATE")
+        orphans = None
+        try:
+            current = conn.execute("PRAGMA user_version").fetchone()[0]
+            if current < version:
+                app.logger.info("DB migration %d: %s", version, step.__name__)
+                orphans = step(conn.cursor())
+                conn.execute(f"PRAGMA user_version={version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        if orphans:
+            remove_blobs(orphans, conn)
+
+# -------------------- Damage terms --------------------
+def split_damage_terms(damage):
+    # กติกาเดียวกับ Top 5 เดิม (Counter ของ damage.split())
+    return damage.split() if damage else []
+
+def sync_damage_terms(c, record_id, damage):
+    """เขียน damage_terms ของ record ใหม่ (เรียกใน transaction เดียวกับ INSERT/UPDATE records)"""
+    c.execute("DELETE FROM damage_terms WHERE record_id = ?", (record_id,))
+    c.executemany("INSERT INTO damage_terms(record_id, term) VALUES (?, ?)",
+                  [(record_id, t) for t in split_damage_terms(damage)])
+
+def damage_term_clause(term):
+    """เงื่อนไข filter damage_word (คลิกจาก Top 5) สำหรับต่อท้าย WHERE ของตาราง records"""
+    return " AND id IN (SELECT record_id FROM damage_terms WHERE term = ?)", [term]
+
+
+# -------------------- Rollups --------------------
+_ROLLUP_ADD = """
+    INSERT INTO records_daily(date_iso, total, damaged)
+    VALUES (IFNULL({r}.date_iso, ''), 1, {r}.damage IS NOT NULL AND {r}.damage <> '')
+    ON CONFLICT(date_iso) DO UPDATE SET total = total + 1, damaged = damaged + excluded.damaged;
+    INSERT INTO records_machine_daily(machine_no, date_iso, total, damaged)
+    VALUES (IFNULL({r}.machine_no, ''), IFNULL({r}.date_iso, ''), 1, {r}.damage IS NOT NULL AND {r}.damage <> '')
+    ON CONFLICT(machine_no, date_iso) DO UPDATE SET total = total + 1, damaged = damaged + excluded.damaged;
+"""
+_ROLLUP_SUB = """
+    UPDATE records_daily
+       SET total = total - 1, damaged = damaged - ({r}.damage IS NOT NULL AND {r}.damage <> '')
+     WHERE date_iso = IFNULL({r}.date_iso, '');
+    DELETE FROM records_daily WHERE date_iso = IFNULL({r}.date_iso, '') AND total <= 0;
+    UPDATE records_machine_daily
+       SET total = total - 1, damaged = damaged - ({r}.damage IS NOT NULL AND {r}.damage <> '')
+     WHERE machine_no = IFNULL({r}.machine_no, '') AND date_iso = IFNULL({r}.date_iso, '');
+    DELETE FROM records_machine_daily
+     WHERE machine_no = IFNULL({r}.machine_no, '') AND date_iso = IFNULL({r}.date_iso, '') AND total <= 0;
+"""
+ROLLUP_TRIGGERS = (
+    "CREATE TRIGGER IF NOT EXISTS records_rollup_ai AFTER INSERT ON records BEGIN"
+    + _ROLLUP_ADD.format(r="new") + "END",
+    "CREATE TRIGGER IF NOT EXISTS records_rollup_ad AFTER DELETE ON records BEGIN"
+    + _ROLLUP_SUB.format(r="old") + "END",
+    "CREATE TRIGGER IF NOT EXISTS records_rollup_au AFTER UPDATE OF machine_no, date_iso, damage ON records BEGIN"
+    + _ROLLUP_SUB.format(r="old") + _ROLLUP_ADD.format(r="new") + "END",
+)
+
+def rebuild_rollups(c):
+    """คำนวณตาราง rollup ใหม่ทั้งหมดจาก records (ใช้ตอน migrate หรือถ้าสงสัยว่ายอดเพี้ยน)"""
+    c.execute("DELETE FROM records_daily")
+    c.execute("""INSERT INTO records_daily(date_iso, total, damaged)
+                 SELECT IFNULL(date_iso, ''), COUNT(*), SUM(damage IS NOT NULL AND damage <> '')
+                 FROM records GROUP BY IFNULL(date_iso, '')""")
+    c.execute("DELETE FROM records_machine_daily")
+    c.execute("""INSERT INTO records_machine_daily(machine_no, date_iso, total, damaged)
+                 SELECT IFNULL(machine_no, ''), IFNULL(date_iso, ''), COUNT(*),
+                        SUM(damage IS NOT NULL AND damage <> '')
+                 FROM records GROUP BY IFNULL(machine_no, ''), IFNULL(date_iso, '')""")
+
+@app.cli.command("rebuild-rollups")
+def rebuild_rollups_command():
+    """flask --app app_interactive_header_filters_patched rebuild-rollups"""
+    conn = _connect()
+    with conn:
+        rebuild_rollups(conn.cursor())
+    conn.close()
+    print("✅ rebuilt records_daily / records_machine_daily")
+
+def rollups_allowed(search=None, damage_filter=None):
+    # rollup เก็บแค่ (วัน, รถ, เสียหายหรือไม่) → ใช้ได้เมื่อไม่มีตัวกรองข้อความ
+    return not search and not damage_filter
+
+
+# -------------------- Attachment storage --------------------
+# ไฟล์แนบเก็บตามเนื้อหา: uploads/ab/cd/<sha256> (แตก 2 ชั้น → ไม่มีโฟลเดอร์ไหนมีไฟล์เป็นหมื่น)
+# รูปเดียวกันอัปโหลดกี่ครั้งก็เก็บ blob เดียว; blobs.refcount = จำนวนแถว attachments ที่อ้างถึง
+# attachments หนึ่งแถวต่อไฟล์แนบ: stored_name = คีย์ของ URL /uploads/<stored_name>, original_name = ชื่อไว้แสดงผล
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+def blob_path(sha256):
+    return os.path.join(UPLOAD_DIR, sha256[:2], sha256[2:4], sha256)
+
+def hash_file(path):
+    """(sha256, ขนาด) ของไฟล์บนดิสก์ อ่านทีละ chunk"""
+    digest, size = hashlib.sha256(), 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+def spool_upload(file):
+    """
+    เขียนไฟล์ที่อัปโหลดลง UPLOAD_TMP_DIR ทีละ chunk พร้อมคำนวณ SHA-256 (ไม่อ่านทั้งไฟล์เข้า memory)
+    คืน (tmp_path, sha256, ขนาด); ใหญ่เกิน MAX_FILE_SIZE → ลบ temp แล้วคืน None
+    """
+    digest, size = hashlib.sha256(), 0
+    fd, tmp_path = tempfile.mkstemp(dir=UPLOAD_TMP_DIR)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b""):
+                size += len(chunk)
+                if size > MAX_FILE_SIZE:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    if size > MAX_FILE_SIZE:
+        os.remove(tmp_path)
+        return None
+    return tmp_path, digest.hexdigest(), size
+
+def spool_uploads(files):
+    """
+    ไฟล์จากฟอร์ม (นามสกุลที่อนุญาต) → [(ชื่อไฟล์เดิม, ผลของ spool_upload)]
+    มีไฟล์ใหญ่เกิน → flash แจ้ง, ทิ้ง temp ทั้งหมด แล้วคืน None
+    """
+    spooled = []
+    for file in files:
+        if file and file.filename and allowed_file(file.filename):
+            sp = spool_upload(file)
+            if sp is None:
+                flash(f"❌ ไฟล์ {file.filename} ใหญ่เกิน 20MB", "danger")
+                for _, (tmp_path, _, _) in spooled:
+                    os.remove(tmp_path)
+                return None
+            # เก็บชื่อเดิมไว้แสดงผล (ตัด path ที่ browser บางตัวส่งมาด้วย)
+            spooled.append((file.filename.replace("\\", "/").rsplit("/", 1)[-1], sp))
+    return spooled
+
+def place_blob(src, sha256, keep_source=False):
+    """วางเนื้อหาไว้ที่ blob_path (ถ้ามีอยู่แล้ว = ไฟล์ซ้ำ ไม่ต้องเขียนใหม่)"""
+    dest = blob_path(sha256)
+    if os.path.exists(dest):
+        if not keep_source:
+            os.remove(src)
+        return
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if keep_source:
+        try:
+            os.link(src, dest)
+        except OSError:   # filesystem ไม่รองรับ hard link
+            shutil.copyfile(src, dest)
+    else:
+        os.replace(src, dest)
+
+def add_blob_ref(c, sha256, size):
+    c.execute("""INSERT INTO blobs(sha256, size, refcount, created_at) VALUES (?, ?, 1, ?)
+                 ON CONFLICT(sha256) DO UPDATE SET refcount = refcount + 1""",
+              (sha256, size, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+
+def store_upload(c, record_id, spooled, original_name):
+    """
+    ย้ายไฟล์จาก spool_upload() เข้า blob store + เพิ่มแถว attachments ของ record → คืน stored_name
+    เรียกใน transaction เดียวกับที่เขียน records: เขียน DB ก่อนแตะไฟล์ → ถือล็อกเขียนของ SQLite อยู่
+    จึงไม่ชนกับ remove_blobs() ที่กำลังลบ blob เดียวกัน
+    ไฟล์ถูกวางก่อน commit → ถ้า transaction ไม่ commit ผู้เรียกต้อง remove_blobs() sha256 ที่วางไป
+    (process ตายกลางทาง → flask sweep-blobs)
+    """
+    tmp_path, sha256, size = spooled
+    add_blob_ref(c, sha256, size)
+    place_blob(tmp_path, sha256)
+    stored_name = f"{secrets.token_hex(6)}_{secure_filename(original_name) or 'file'}"
+    c.execute("""INSERT INTO attachments(record_id, stored_name, original_name, size, mime, sha256, created_at)
+                 VALUES (?, ?, ?, ?, ?, ?, ?)""",
+              (record_id, stored_name, original_name, size, guess_mime(original_name), sha256,
+               datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    return stored_name
+
+def release_attachments(c, record_id, stored_names=None):
+    """
+    ลบ attachments ของ record (ทั้งหมด หรือเฉพาะ stored_names) + ลด refcount (ใน transaction ของผู้เรียก)
+    คืน (จำนวนไฟล์แนบที่ลบ, sha256 ของ blob ที่ไม่เหลือใครอ้างถึง) → ผู้เรียก remove_blobs() หลัง commit สำเร็จ
+    (ลบไฟล์ก่อน commit แล้ว commit ล้ม → DB ยังชี้ไฟล์ที่หายไปแล้ว)
+    """
+    released, orphans = 0, []
+    rows = c.execute("SELECT id, stored_name, sha256 FROM attachments WHERE record_id = ?",
+                     (record_id,)).fetchall()
+    for att_id, stored_name, sha256 in rows:
+        if stored_names is not None and stored_name not in stored_names:
+            continue
+        c.execute("DELETE FROM attachments WHERE id = ?", (att_id,))
+        c.execute("UPDATE blobs SET refcount = refcount - 1 WHERE sha256 = ?", (sha256,))
+        if c.execute("SELECT refcount FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()[0] <= 0:
+            c.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+            orphans.append(sha256)
+        released += 1
+    return released, orphans
+
+def remove_blobs(shas, conn=None):
+    """
+    ลบไฟล์ของ blob ที่ไม่มีแถวใน blobs แล้ว — เรียกหลัง commit (หรือ rollback) เท่านั้น
+    เช็กซ้ำภายใต้ล็อกเขียน: ระหว่างนั้นอาจมีคนอัปโหลดเนื้อหาเดียวกันกลับเข้ามา (store_upload ถือล็อกตอนวางไฟล์)
+    """
+    shas = list(dict.fromkeys(shas))
+    conn = conn or get_db()
+    for i in range(0, len(shas), 500):   # ไม่ถือล็อกเขียนนานเกินไป
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError:
+            # DB ยุ่งเกิน busy_timeout → ข้อมูลถูกต้องแล้ว เหลือแค่ไฟล์ขยะ ไม่ให้ request ล้มเพราะเรื่องนี้
+            app.logger.warning("ลบ blob %d ไฟล์ไม่สำเร็จ (เก็บกวาดทีหลังด้วย flask sweep-blobs)", len(shas) - i)
+            return
+        try:
+            for sha256 in shas[i:i + 500]:
+                if conn.execute("SELECT 1 FROM blobs WHERE sha256 = ?", (sha256,)).fetchone():
+                    continue
+                try:
+                    os.remove(blob_path(sha256))
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    app.logger.warning("ลบ blob %s ไม่สำเร็จ (เก็บกวาดทีหลังด้วย flask sweep-blobs)", sha256)
+        finally:
+            conn.rollback()   # อ่านอย่างเดียว: แค่ปล่อยล็อก
+
+def discard_spooled(spooled, conn=None):
+    """transaction ที่ store_upload() ไม่ได้ commit → ลบ temp ที่ยังไม่ถูกย้าย + blob ที่วางไปแล้วแต่ไม่มีใครอ้างถึง"""
+    for _, (tmp_path, _, _) in spooled:
+        try: os.remove(tmp_path)
+        except FileNotFoundError: pass
+    remove_blobs([sha256 for _, (_, sha256, _) in spooled], conn)
+
+def iter_blob_shas():
+    """sha256 ของทุกไฟล์ใน blob store (uploads/ab/cd/<sha256>)"""
+    for top in os.scandir(UPLOAD_DIR):
+        if not (top.is_dir() and len(top.name) == 2):
+            continue
+        for mid in os.scandir(top.path):
+            if mid.is_dir():
+                for entry in os.scandir(mid.path):
+                    if entry.is_file() and len(entry.name) == 64:
+                        yield entry.name
+
+@app.cli.command("sweep-blobs")
+def sweep_blobs_command():
+    """flask --app app_interactive_header_filters_patched sweep-blobs — ลบ blob ที่ไม่มีแถวใน blobs (เช่น process ตายก่อน commit)"""
+    conn = _connect()
+    known = {sha256 for (sha256,) in conn.execute("SELECT sha256 FROM blobs")}
+    orphans = [sha256 for sha256 in iter_blob_shas() if sha256 not in known]
+    remove_blobs(orphans, conn)
+    conn.close()
+    print(f"✅ checked {len(orphans)} unreferenced blobs")
+
+def guess_mime(name):
+    return mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+def find_attachment(stored_name, conn=None):
+    """stored_name (จาก URL) → (path ของ blob, ชื่อไฟล์เดิม, mime, sha256, ขนาด) หรือ None"""
+    row = (conn or get_db()).execute(
+        "SELECT sha256, original_name, mime, size FROM attachments WHERE stored_name = ?",
+        (stored_name,)).fetchone()
+    return (blob_path(row[0]), row[1], row[2], row[0], row[3]) if row else None
+
+def record_attachments(record_id, conn=None):
+    """[(stored_name, path, ชื่อไฟล์เดิม)] ของ record เดียว ตามลำดับที่แนบ"""
+    return rows_attachments([record_id], conn)[record_id]
+
+def rows_attachments(record_ids, conn=None):
+    """{record id: record_attachments()} ของทั้ง batch ด้วย query เดียวต่อ 500 record"""
+    conn = conn or get_db()
+    found = {rid: [] for rid in record_ids}
+    ids = list(found)
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        sql = ("SELECT record_id, stored_name, sha256, original_name FROM attachments"
+               f" WHERE record_id IN ({','.join('?' * len(chunk))}) ORDER BY record_id, id")
+        for rid, stored_name, sha256, original_name in conn.execute(sql, chunk):
+            found[rid].append((stored_name, blob_path(sha256), original_name))
+    return found
+
+# ชื่อไฟล์แบบเดิม (secure_filename → ไม่มี tab/ขึ้นบรรทัด) → sha256 ของเนื้อหา, บรรทัดละ "ชื่อ\tsha256\tขนาด"
+# อยู่นอก DB → restore backup ก่อน migration 010 ไม่ทำให้หาย; ชื่อเดียวกันหลายบรรทัด = ใช้บรรทัดล่าสุด
+LEGACY_UPLOAD_MAP = os.path.join(UPLOAD_DIR, "legacy_names.tsv")
+
+def load_legacy_map():
+    """{ชื่อไฟล์แบบเดิม: (sha256, ขนาด)} จาก LEGACY_UPLOAD_MAP"""
+    found = {}
+    try:
+        with open(LEGACY_UPLOAD_MAP, encoding="utf-8") as f:
+            for line in f:
+                parts = line.rstrip("\n").split("\t")
+                if len(parts) == 3:   # บรรทัดท้ายที่เขียนไม่จบ (เครื่องดับ) → ข้าม
+                    found[parts[0]] = (parts[1], int(parts[2]))
+    except FileNotFoundError:
+        pass
+    return found
+
+def remember_legacy_uploads(entries):
+    """ต่อท้าย [(ชื่อเดิม, sha256, ขนาด)] ลง LEGACY_UPLOAD_MAP แล้ว fsync (ก่อนจะมีใครลบไฟล์แบนได้)"""
+    if not entries:
+        return
+    with open(LEGACY_UPLOAD_MAP, "a", encoding="utf-8") as f:
+        f.writelines(f"{name}\t{sha256}\t{size}\n" for name, sha256, size in entries)
+        f.flush()
+        os.fsync(f.fileno())
+
+def prune_legacy_uploads(conn):
+    """
+    ลบไฟล์แบบเดิมที่วางแบนใน UPLOAD_DIR ซึ่งอยู่ใน LEGACY_UPLOAD_MAP และ blob ยังถูกอ้างถึงอยู่ → คืนจำนวนที่ลบ
+    รันครั้งเดียวหลังอัปเกรด (flask prune-legacy-uploads) ไม่ใช่ทุกครั้งที่ start
+    """
+    legacy = load_legacy_map()
+    with os.scandir(UPLOAD_DIR) as it:
+        names = [e.name for e in it if e.is_file() and e.name in legacy]
+    removed = 0
+    for name in names:
+        sha256, _ = legacy[name]
+        if not (os.path.isfile(blob_path(sha256))
+                and conn.execute("SELECT 1 FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()):
+            continue   # blob ยังไม่มี/กำลังจะถูกลบ → ไฟล์แบนอาจเป็นสำเนาสุดท้าย
+        try:
+            os.remove(os.path.join(UPLOAD_DIR, name))
+            removed += 1
+        except FileNotFoundError:
+            pass   # อีก process ลบไปก่อนแล้ว
+    return removed
+
+@app.cli.command("prune-legacy-uploads")
+def prune_legacy_uploads_command():
+    """flask --app app_interactive_header_filters_patched prune-legacy-uploads"""
+    conn = _connect()
+    removed = prune_legacy_uploads(conn)
+    conn.close()
+    print(f"✅ removed {removed} legacy upload files")
+
+FTS_ENABLED = False
+
 def init_db():
-    with sqlite3.connect(DB_NAME) as conn:
+    global FTS_ENABLED
+    conn = _connect()
+    migrate_db(conn)
+    FTS_ENABLED = ensure_records_fts(conn)
+    with conn:
         c = conn.cursor()
-        c.execute("""CREATE TABLE IF NOT EXISTS users(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE, password_hash TEXT, role TEXT)""")
-        c.execute("""CREATE TABLE IF NOT EXISTS records(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            machine_no TEXT, name TEXT,
-            date_text TEXT, date_iso TEXT,
-            comments TEXT, damage TEXT,
-            created_by TEXT, created_at_iso TEXT,
-            file_path TEXT)""")
-        conn.commit()
         if not c.execute("SELECT 1 FROM users").fetchone():
             c.execute("INSERT INTO users(username,password_hash,role) VALUES(?,?,?)",
                       ("admin", generate_password_hash("Admin@123"), "admin"))
             conn.commit()
+    # ปิดทิ้ง: ไม่ให้ connection ของ master process ติดไปกับ worker ที่ fork ออกมา
+    conn.close()
 
-with app.app_context():
-    init_db()
+# รันด้วย python ตรง ๆ: process ลูกของ sheet pool (spawn) import ไฟล์นี้ซ้ำในชื่อ __mp_main__
+# → ไม่ต้อง migrate DB / compile template ในนั้น (งานของลูกอยู่ใน pdf_reports ทั้งหมด)
+POOL_CHILD = __name__ == "__mp_main__"
+
+if not POOL_CHILD:
+    with app.app_context():
+        init_db()
 # -------------------- CSS --------------------
 THEME_CSS = """
 <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css" rel="stylesheet">
@@ -214,21 +924,196 @@ h4, h5 {
 .container-narrow { max-width:700px; margin:auto; }
 </style>
 """
+register_template("theme.html", THEME_CSS)
 
 
 # -------------------- Upload Serving --------------------
+# ETag = sha256 ของเนื้อหา (strong), cache ส่วนตัวได้นาน (stored_name ผูกกับเนื้อหาที่ไม่เปลี่ยน), รองรับ Range (PDF ใหญ่)
+# ATTACHMENT_OFFLOAD: "" = worker ส่งไฟล์เอง, "x-accel" = nginx (X-Accel-Redirect), "x-sendfile" = Apache/lighttpd
+#   โหมด offload: Flask แค่ตรวจสิทธิ์/ตอบ 304 แล้วให้ web server ส่ง bytes (รวมถึง Range) → worker ไม่ค้างกับไฟล์ใหญ่
+#   nginx: location /_attachments/ { internal; alias <UPLOAD_DIR>/; }
+ATTACHMENT_OFFLOAD = os.environ.get("ATTACHMENT_OFFLOAD", "").lower()
+ATTACHMENT_ACCEL_PREFIX = os.environ.get("ATTACHMENT_ACCEL_PREFIX", "/_attachments/")
+ATTACHMENT_MAX_AGE = 365 * 24 * 3600
+
 @app.route("/uploads/<path:filename>")
 @login_required
 def uploaded_file(filename):
-    return send_from_directory(UPLOAD_DIR, filename)
+    found = find_attachment(filename)
+    if not found or not os.path.isfile(found[0]):
+        return "File not found", 404
+    path, original_name, mime, sha256, _ = found
+    offload = ATTACHMENT_OFFLOAD in ("x-accel", "x-sendfile")
+    environ = request.environ
+    if offload:
+        # response ไม่มี body ให้ตัด → ให้ web server ตอบ Range จากไฟล์จริงเอง
+        environ = {k: v for k, v in environ.items() if k not in ("HTTP_RANGE", "HTTP_IF_RANGE")}
+    # blob บนดิสก์ไม่มีนามสกุล → ชนิดไฟล์/ชื่อตอนดาวน์โหลดมาจาก attachments
+    # (flask.send_file ผูก X-Sendfile กับ config ทั้งแอป → ใช้ของ werkzeug ตรง ๆ เปิดเฉพาะไฟล์แนบ)
+    try:
+        resp = werkzeug_send_file(path, environ, mimetype=mime, download_name=original_name,
+                                  conditional=True, etag=sha256, max_age=ATTACHMENT_MAX_AGE,
+                                  use_x_sendfile=offload, response_class=app.response_class)
+    except RequestedRangeNotSatisfiable as e:
+        # handler Exception รวมของแอปจะกลายเป็น 500 → ตอบ 416 (+ Content-Range: bytes */size) ตรงนี้
+        return e.get_response()
+    resp.cache_control.public = False
+    resp.cache_control.private = True
+    resp.cache_control.immutable = True
+    if ATTACHMENT_OFFLOAD == "x-accel" and "X-Sendfile" in resp.headers:
+        del resp.headers["X-Sendfile"]
+        rel = os.path.relpath(path, UPLOAD_DIR).replace(os.sep, "/")
+        resp.headers["X-Accel-Redirect"] = ATTACHMENT_ACCEL_PREFIX + rel
+    return resp
+
+@app.route("/records/<int:record_id>/files")
+@login_required
+def record_files(record_id):
+    # รายการไฟล์แนบของ record เดียว (modal หน้า index โหลดเมื่อเปิดดูเท่านั้น)
+    with get_db() as conn:
+        if not conn.execute("SELECT 1 FROM records WHERE id=?", (record_id,)).fetchone():
+            return {"error": "Record not found"}, 404
+        files = record_attachments(record_id, conn)
+    return {"record_id": record_id,
+            "zip_url": url_for("record_attachments_zip", record_id=record_id),
+            "files": [{"name": original_name, "url": url_for("uploaded_file", filename=stored_name),
+                       "thumb_url": thumb_url(stored_name, original_name, "sm"),
+                       "thumb_url_2x": thumb_url(stored_name, original_name, "md")}
+                      for stored_name, _, original_name in files]}
+
+# -------------------- Thumbnails --------------------
+# รูปย่อของไฟล์แนบที่เป็นรูป: สร้างครั้งแรกที่มีคนขอ แล้วเก็บใน THUMB_DIR (จำกัดขนาดรวม, ลบที่ไม่ได้ใช้นานสุดก่อน)
+# key = sha256 ของต้นฉบับ + ขนาด + format → รูปเดียวกันที่แนบหลาย record ใช้ไฟล์ย่อร่วมกัน
+THUMB_SIZES = {"sm": 160, "md": 480, "lg": 1280}   # ด้านยาวสุด (px)
+THUMB_EXTS = {"jpg", "jpeg", "png", "gif", "webp"}
+THUMB_QUALITY = 80
+THUMB_DIR_MAX_BYTES = 256 * 1024 * 1024
+THUMB_MAX_AGE = 365 * 24 * 3600                    # URL ผูกกับเนื้อหาที่ไม่เปลี่ยน → browser cache ได้ยาว
+THUMB_WEBP = pil_features.check("webp")
+THUMB_RESCAN_INTERVAL = 600                        # วินาที: walk THUMB_DIR ใหม่อย่างน้อยเท่านี้ (worker อื่นก็เขียนเพิ่ม)
+_thumb_slots = threading.BoundedSemaphore(2)       # decode รูปจากมือถือพร้อมกันไม่เกินนี้ต่อ process (กิน RAM/CPU)
+_thumb_bytes = None                                # ขนาดรวมโดยประมาณของ THUMB_DIR (walk ล่าสุด + ที่ process นี้สร้างเพิ่ม)
+_thumb_scanned_at = 0.0
+_thumb_lock = threading.Lock()
+
+def thumb_url(stored_name, original_name, size):
+    """URL รูปย่อ; ไฟล์ที่ไม่ใช่รูป → None (modal/หน้า edit แสดงเป็นชื่อไฟล์แทน)"""
+    if original_name.rsplit(".", 1)[-1].lower() not in THUMB_EXTS:
+        return None
+    return url_for("attachment_thumb", size=size, filename=stored_name)
+
+def thumb_path(sha256, size, fmt):
+    return os.path.join(THUMB_DIR, sha256[:2], f"{sha256}_{size}.{fmt}")
+
+def make_thumbnail(src, dest, px, fmt):
+    with PILImage.open(src) as im:
+        im.draft("RGB", (px, px))   # JPEG: ให้ decoder ย่อ 1/2–1/8 ตั้งแต่ตอนอ่าน (รูป 12MP ไม่ต้อง decode เต็ม)
+        im = ImageOps.exif_transpose(im)   # รูปจากมือถือเก็บการหมุนไว้ใน EXIF
+        im.thumbnail((px, px))
+        if im.mode not in (("RGB", "RGBA") if fmt == "webp" else ("RGB",)):
+            im = im.convert("RGBA" if fmt == "webp" and "A" in im.getbands() else "RGB")
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                im.save(out, "WEBP" if fmt == "webp" else "JPEG", quality=THUMB_QUALITY)
+            os.replace(tmp_path, dest)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+def evict_thumbnails(keep=None):
+    """
+    ลบรูปย่อที่ไม่ได้ใช้นานสุด (mtime) จนขนาดรวมไม่เกิน THUMB_DIR_MAX_BYTES; keep = ไฟล์ที่กำลังจะส่ง
+    คืนขนาดรวมที่เหลือ (walk ทั้ง THUMB_DIR → เรียกผ่าน note_thumbnail() ไม่ใช่ทุกครั้งที่สร้างรูป)
+    """
+    files = []
+    for shard in os.scandir(THUMB_DIR):
+        if not shard.is_dir():
+            continue
+        for entry in os.scandir(shard.path):
+            if entry.is_file() and not entry.name.endswith(".part"):
+                st = entry.stat()
+                files.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= THUMB_DIR_MAX_BYTES:
+            break
+        if path == keep:
+            continue
+        try: os.remove(path)
+        except OSError: pass
+        total -= size
+    return total
+
+def note_thumbnail(path):
+    """
+    นับรูปย่อที่เพิ่งสร้างเข้ายอดรวม; walk THUMB_DIR (evict_thumbnails) เฉพาะเมื่อยอดเกินเพดาน
+    หรือไม่ได้ walk มาเกิน THUMB_RESCAN_INTERVAL (ยอดของ process นี้ไม่รวมที่ worker อื่นสร้าง)
+    """
+    global _thumb_bytes, _thumb_scanned_at
+    size = os.path.getsize(path)
+    with _thumb_lock:
+        if _thumb_bytes is not None:
+            _thumb_bytes += size
+            if (_thumb_bytes <= THUMB_DIR_MAX_BYTES
+                    and time.time() - _thumb_scanned_at < THUMB_RESCAN_INTERVAL):
+                return
+        _thumb_scanned_at = time.time()
+        _thumb_bytes = evict_thumbnails(keep=path)
+
+@app.route("/thumbs/<size>/<path:filename>")
+@login_required
+def attachment_thumb(size, filename):
+    found = find_attachment(filename)
+    if size not in THUMB_SIZES or not found or not thumb_url(filename, found[1], size):
+        return "Preview not available", 404
+    src, _, _, sha256, _ = found
+    accepts_webp = any(mt == "image/webp" and q > 0 for mt, q in request.accept_mimetypes)
+    fmt = "webp" if THUMB_WEBP and accepts_webp else "jpeg"
+    path = thumb_path(sha256, size, fmt)
+    try:
+        src_mtime = os.stat(src).st_mtime
+    except FileNotFoundError:
+        return "Preview not available", 404
+    try:
+        os.utime(path)   # hit → ขยับเป็นใช้ล่าสุด (LRU ตาม mtime)
+    except FileNotFoundError:
+        with _thumb_slots:
+            if not os.path.exists(path):   # อีก request อาจสร้างเสร็จระหว่างรอคิว
+                try:
+                    make_thumbnail(src, path, THUMB_SIZES[size], fmt)
+                except (OSError, ValueError, PILImage.DecompressionBombError):
+                    return "Preview not available", 404   # ไฟล์เสีย/ไม่ใช่รูปจริง
+                note_thumbnail(path)
+    # mtime ของรูปย่อขยับทุก hit (LRU) → ETag/Last-Modified ต้องมาจากต้นฉบับ ไม่งั้น If-None-Match ไม่เคยได้ 304
+    resp = send_file(path, mimetype=f"image/{fmt}", max_age=THUMB_MAX_AGE,
+                     etag=f"{sha256}-{size}-{fmt}", last_modified=src_mtime)
+    resp.cache_control.public = False
+    resp.cache_control.private = True
+    resp.vary.add("Accept")   # format ขึ้นกับ Accept ของ browser
+    return resp
 
 # -------------------- Auth --------------------
+register_template("login.html", """{% include "theme.html" %}
+<div class="d-flex justify-content-center align-items-center vh-100">
+  <div class="card shadow p-4 container-narrow">
+    <h4 class="mb-3 text-center">🔐 Login</h4>
+    <form method="post" class="d-flex flex-column gap-2">
+      <input name="username" class="form-control" placeholder="Username / ชื่อผู้ใช้" required>
+      <input name="password" type="password" class="form-control" placeholder="Password / รหัสผ่าน" required>
+      <button class="btn btn-primary w-100">Login</button>
+    </form>
+  </div>
+</div>
+""")
+
 @app.route("/login",methods=["GET","POST"])
 def login():
     if request.method=="POST":
         u = request.form["username"].strip()
         p = request.form["password"]
-        with sqlite3.connect(DB_NAME) as conn:
+        with get_db() as conn:
             c = conn.cursor()
             user = c.execute("SELECT id,username,password_hash,role FROM users WHERE username=?",(u,)).fetchone()
         if not user or not check_password_hash(user[2], p):
@@ -236,18 +1121,7 @@ def login():
             return redirect(url_for("login"))
         session.update({"user_id":user[0], "username":user[1], "role":user[3]})
         return redirect(url_for("index"))
-    return render_template_string(THEME_CSS + """
-<div class="d-flex justify-content-center align-items-center vh-100">
-  <div class="card shadow p-4 container-narrow">
-    <h4 class="mb-3 text-center">🔐 Login</h4>
-    <form method="post" class="d-flex flex-column gap-2">
-      <input name="username" class="form-control" placeholder="Username / ชื่อผู้ใช้" required>
-      <input name="password" type="password" class="form-control" placeholder="Password / รหัสผ่าน" required>
-      <button class="btn btn-primary w-100">Login</button>
-    </form>
-  </div>
-</div>
-""")
+    return render_template("login.html")
 
 @app.route("/logout")
 @login_required
@@ -256,13 +1130,25 @@ def logout():
     return redirect(url_for("login"))
 
 # -------------------- Change Password --------------------
+register_template("change_password.html", """{% include "theme.html" %}
+<div class="container-narrow mt-3">
+  <h4>🔑 Change Password</h4>
+  <form method="post" class="card p-3 shadow-sm d-flex flex-column gap-2">
+    <input type="password" name="old_password" class="form-control" placeholder="Current Password / รหัสผ่านเดิม" required>
+    <input type="password" name="new_password" class="form-control" placeholder="New Password / รหัสผ่านใหม่" required>
+    <button class="btn btn-primary">Update</button>
+    <a href="{{url_for('index')}}" class="btn btn-secondary">Cancel</a>
+  </form>
+</div>
+""")
+
 @app.route("/change_password", methods=["GET","POST"])
 @login_required
 def change_password():
     if request.method == "POST":
         old_pw = request.form["old_password"]
         new_pw = request.form["new_password"]
-        with sqlite3.connect(DB_NAME) as conn:
+        with get_db() as conn:
             c = conn.cursor()
             user = c.execute("SELECT id,password_hash FROM users WHERE id=?",(session["user_id"],)).fetchone()
             if not user or not check_password_hash(user[1], old_pw):
@@ -272,17 +1158,7 @@ def change_password():
             conn.commit()
         flash("✅ Password changed", "success")
         return redirect(url_for("index"))
-    return render_template_string(THEME_CSS + """
-<div class="container-narrow mt-3">
-  <h4>🔑 Change Password</h4>
-  <form method="post" class="card p-3 shadow-sm d-flex flex-column gap-2">
-    <input type="password" name="old_password" class="form-control" placeholder="Current Password / รหัสผ่านเดิม" required>
-    <input type="password" name="new_password" class="form-control" placeholder="New Password / รหัสผ่านใหม่" required>
-    <button class="btn btn-primary">Update</button>
-    <a href="{{url_for('index')}}" class="btn btn-secondary">Cancel</a>
-  </form>
-</div>
-""")
+    return render_template("change_password.html")
 
 # -------------------- Backup (Download DB) --------------------
 @app.route("/backup_db")
@@ -291,29 +1167,24 @@ def backup_db():
     if session.get("role") != "admin":
         return "⛔ ไม่มีสิทธิ์", 403
     filename = f"records_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-    return send_file(DB_NAME, as_attachment=True, download_name=filename)
+    # ห้ามส่งไฟล์ DB ตรง ๆ: checkpoint อาจ busy (มี reader ค้าง เช่น export) และ auto-checkpoint
+    # เขียนทับไฟล์ระหว่างส่งได้ → ใช้ SQLite online backup ทำสำเนาจาก snapshot เดียว แล้วส่งสำเนานั้น
+    fd, tmp_path = tempfile.mkstemp(dir=BASE_DIR, prefix="_backup_", suffix=".db")
+    os.close(fd)
+    try:
+        dest = sqlite3.connect(tmp_path)
+        try:
+            get_db().backup(dest)
+        finally:
+            dest.close()
+        # send_file เปิดไฟล์ไว้แล้ว → ลบชื่อไฟล์ได้ทันที (POSIX: พื้นที่คืนเมื่อส่งเสร็จ/ปิดไฟล์)
+        # call_on_close ใช้ไม่ได้: response แบบ direct_passthrough ไม่เรียก close callback
+        return send_file(tmp_path, as_attachment=True, download_name=filename)
+    finally:
+        os.remove(tmp_path)
 
 # -------------------- User Management --------------------
-@app.route("/users", methods=["GET","POST"])
-@login_required
-def users():
-    if session.get("role") != "admin":
-        return "⛔ ไม่มีสิทธิ์", 403
-    with sqlite3.connect(DB_NAME) as conn:
-        c = conn.cursor()
-        if request.method == "POST":
-            username = request.form["username"].strip()
-            password = request.form["password"]
-            role     = request.form["role"]
-            try:
-                c.execute("INSERT INTO users(username,password_hash,role) VALUES (?,?,?)",
-                          (username, generate_password_hash(password), role))
-                conn.commit()
-                flash("✅ เพิ่มผู้ใช้แล้ว", "success")
-            except sqlite3.IntegrityError:
-                flash("⚠️ ชื่อผู้ใช้นี้มีอยู่แล้ว", "danger")
-        users = c.execute("SELECT id, username, role FROM users ORDER BY id DESC").fetchall()
-    return render_template_string(THEME_CSS + """
+register_template("users.html", """{% include "theme.html" %}
 
 <div class="container mt-3 container-narrow">
   <h4>👥 Users</h4>
@@ -353,70 +1224,31 @@ def users():
     </tbody>
   </table>
 </div>
-""", users=users)
+""")
 
-# ---------- Edit Record ----------
-@app.route("/edit/<int:record_id>", methods=["GET","POST"])
+@app.route("/users", methods=["GET","POST"])
 @login_required
-def edit(record_id):
-    with sqlite3.connect(DB_NAME) as conn:
+def users():
+    if session.get("role") != "admin":
+        return "⛔ ไม่มีสิทธิ์", 403
+    with get_db() as conn:
         c = conn.cursor()
-        r = c.execute("SELECT * FROM records WHERE id=?", (record_id,)).fetchone()
-        if not r:
-            return "Record not found", 404
-
         if request.method == "POST":
-            machine_no = request.form["machine_no"].strip()
-            name = request.form["name"].strip()
-            date_iso = request.form["date_iso"]
-            comments = request.form.get("comments","").strip()
-            damage = request.form.get("damage","").strip()
-
-            # ---------- แนบไฟล์ใหม่ ----------
-            files = request.files.getlist("files")
-            file_paths = r[9].split(";") if r[9] else []
-            for file in files:
-                if file and file.filename and allowed_file(file.filename):
-                    # ✅ เช็คขนาดไฟล์
-                    file.seek(0, os.SEEK_END)
-                    size = file.tell()
-                    file.seek(0)
-                    if size > MAX_FILE_SIZE:
-                        flash(f"❌ ไฟล์ {file.filename} ใหญ่เกิน 20MB", "danger")
-                        return redirect(url_for("edit", record_id=record_id))
-
-                    fname = secure_filename(file.filename)
-                    save_path = os.path.join(UPLOAD_DIR, fname)
-                    if os.path.exists(save_path):
-                        base, ext = os.path.splitext(fname)
-                        fname = f"{base}_{int(datetime.now().timestamp())}{ext}"
-                        save_path = os.path.join(UPLOAD_DIR, fname)
-                    file.save(save_path)
-                    file_paths.append(fname)
-
-            file_path_str = ";".join(file_paths) if file_paths else None
-
-            date_th = request.form["date_iso"]  # ได้ dd/mm/yyyy จาก Flatpickr
-            date_iso = parse_thai_date_to_iso(date_th)
-
-            c.execute("""UPDATE records 
-             SET machine_no=?, name=?, date_text=?, date_iso=?, comments=?, damage=?, file_path=?
-             WHERE id=?""",
-          (machine_no, name, parse_iso_to_text(date_iso), date_iso, comments, damage, file_path_str, record_id))
-            conn.commit()
-            flash("✅ Updated", "success")
-            return redirect(url_for("index"))
-
-    # ---------- Template Edit ----------
-    # 🔹 ตรวจสอบไฟล์จริงก่อนส่งให้ template
-    file_list = []
-    if r[9]:
-        for f in r[9].split(";"):
-            path = os.path.join(UPLOAD_DIR, f)
-            if os.path.exists(path):
-                file_list.append(f)
+            username = request.form["username"].strip()
+            password = request.form["password"]
+            role     = request.form["role"]
+            try:
+                c.execute("INSERT INTO users(username,password_hash,role) VALUES (?,?,?)",
+                          (username, generate_password_hash(password), role))
+                conn.commit()
+                flash("✅ เพิ่มผู้ใช้แล้ว", "success")
+            except sqlite3.IntegrityError:
+                flash("⚠️ ชื่อผู้ใช้นี้มีอยู่แล้ว", "danger")
+        users = c.execute("SELECT id, username, role FROM users ORDER BY id DESC").fetchall()
+    return render_template("users.html", users=users)
 
-    return render_template_string(THEME_CSS + """
+# ---------- Edit Record ----------
+register_template("edit.html", """{% include "theme.html" %}
 
 <div class="container-narrow mt-3">
   <h4>✏️ Edit Record</h4>
@@ -429,8 +1261,14 @@ def edit(record_id):
 
     {% if file_list %}
       <label>📎 Attached Files</label><br>
-      {% for f in file_list %}
-        <a href="{{url_for('uploaded_file',filename=f)}}" target="_blank">{{f}}</a>
+      {% for f, original_name in file_list %}
+        {% set thumb = thumb_url(f, original_name, 'sm') %}
+        {% if thumb %}
+        <a href="{{url_for('uploaded_file',filename=f)}}" target="_blank"><img
+           src="{{ thumb }}" srcset="{{ thumb }} 1x, {{ thumb_url(f, original_name, 'md') }} 2x"
+           alt="{{original_name}}" height="80" loading="lazy" class="rounded border me-2"></a>
+        {% endif %}
+        <a href="{{url_for('uploaded_file',filename=f)}}" target="_blank">{{original_name}}</a>
         <a href="{{url_for('delete_file', record_id=r[0], filename=f)}}"
            onclick="return confirm('ลบไฟล์นี้แน่ใจมั้ย?')"
            class="btn btn-sm btn-danger ms-2">ลบ</a><br>
@@ -454,26 +1292,68 @@ def edit(record_id):
     defaultDate: "{{r[4]}}"
   });
 </script>
-""", r=r, file_list=file_list)
+""")
+
+@app.route("/edit/<int:record_id>", methods=["GET","POST"])
+@login_required
+def edit(record_id):
+    with get_db() as conn:
+        c = conn.cursor()
+        r = c.execute(f"SELECT {RECORD_COLUMNS} FROM records WHERE id=?", (record_id,)).fetchone()
+        if not r:
+            return "Record not found", 404
+
+        if request.method == "POST":
+            machine_no = request.form["machine_no"].strip()
+            name = request.form["name"].strip()
+            date_iso = request.form["date_iso"]
+            comments = request.form.get("comments","").strip()
+            damage = request.form.get("damage","").strip()
+
+            # ---------- แนบไฟล์ใหม่ ----------
+            spooled = spool_uploads(request.files.getlist("files"))
+            if spooled is None:
+                return redirect(url_for("edit", record_id=record_id))
+            try:
+                for original_name, sp in spooled:
+                    store_upload(c, record_id, sp, original_name)
+
+                date_th = request.form["date_iso"]  # ได้ dd/mm/yyyy จาก Flatpickr
+                date_iso = parse_thai_date_to_iso(date_th)
+
+                c.execute("""UPDATE records 
+                 SET machine_no=?, name=?, date_text=?, date_iso=?, comments=?, damage=?
+                 WHERE id=?""",
+              (machine_no, name, parse_iso_to_text(date_iso), date_iso, comments, damage, record_id))
+                sync_damage_terms(c, record_id, damage)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                discard_spooled(spooled, conn)
+                raise
+            flash("✅ Updated", "success")
+            return redirect(url_for("index"))
+
+    # ---------- Template Edit ----------
+    # 🔹 เฉพาะไฟล์ที่อยู่ใน blob store: [(stored_name, ชื่อไฟล์เดิม)]
+    file_list = [(stored_name, original_name) for stored_name, _, original_name in record_attachments(record_id)]
+
+    return render_template("edit.html", r=r, file_list=file_list, thumb_url=thumb_url)
 
 
 # ---------- Delete Record ----------
 @app.route("/delete/<int:record_id>")
 @login_required
 def delete(record_id):
-    with sqlite3.connect(DB_NAME) as conn:
+    with get_db() as conn:
         c = conn.cursor()
-        # ดึงไฟล์แนบออกมาก่อน
-        rec = c.execute("SELECT file_path FROM records WHERE id=?", (record_id,)).fetchone()
-        if rec and rec[0]:
-            for f in rec[0].split(";"):
-                path = os.path.join(UPLOAD_DIR, f)
-                if os.path.exists(path):
-                    os.remove(path)   # 🔹 ลบไฟล์จริงออกจากโฟลเดอร์
+        # ลบไฟล์แนบก่อน (ไฟล์จริงลบเมื่อไม่มี record อื่นใช้เนื้อหาเดียวกัน)
+        _, orphans = release_attachments(c, record_id)
 
         # ลบ record ออกจาก DB
         c.execute("DELETE FROM records WHERE id=?", (record_id,))
         conn.commit()
+    remove_blobs(orphans)
 
     flash("🗑️ ลบข้อมูลและไฟล์เรียบร้อย", "info")
     return redirect(url_for("index"))
@@ -481,20 +1361,14 @@ def delete(record_id):
 @app.route("/delete_file/<int:record_id>/<filename>")
 @login_required
 def delete_file(record_id, filename):
-    with sqlite3.connect(DB_NAME) as conn:
+    with get_db() as conn:
         c = conn.cursor()
-        rec = c.execute("SELECT file_path FROM records WHERE id=?", (record_id,)).fetchone()
-        if rec and rec[0]:
-            files = rec[0].split(";")
-            if filename in files:
-                files.remove(filename)
-                new_files = ";".join(files) if files else None
-                c.execute("UPDATE records SET file_path=? WHERE id=?", (new_files, record_id))
-                conn.commit()
-                path = os.path.join(UPLOAD_DIR, filename)
-                if os.path.exists(path):
-                    os.remove(path)   # 🔹 ลบไฟล์จริงออกจากโฟลเดอร์
-                flash("✅ ลบไฟล์แล้ว", "success")
+        # 🔹 ไฟล์จริงลบเมื่อไม่มี record อื่นใช้เนื้อหาเดียวกัน
+        released, orphans = release_attachments(c, record_id, [filename])
+        if released:
+            conn.commit()
+            remove_blobs(orphans)
+            flash("✅ ลบไฟล์แล้ว", "success")
     return redirect(url_for("edit", record_id=record_id))
 
 @app.route("/delete_user/<int:user_id>")
@@ -502,7 +1376,7 @@ def delete_file(record_id, filename):
 def delete_user(user_id):
     if session.get("role") != "admin":
         return "⛔ ไม่มีสิทธิ์", 403
-    with sqlite3.connect(DB_NAME) as conn:
+    with get_db() as conn:
         c = conn.cursor()
         user = c.execute("SELECT username FROM users WHERE id=?", (user_id,)).fetchone()
         if user and user[0] == "admin":
@@ -518,7 +1392,7 @@ def delete_user(user_id):
 def reset_password(user_id):
     if session.get("role") != "admin":
         return "⛔ ไม่มีสิทธิ์", 403
-    with sqlite3.connect(DB_NAME) as conn:
+    with get_db() as conn:
         c = conn.cursor()
         user = c.execute("SELECT username FROM users WHERE id=?", (user_id,)).fetchone()
         if user and user[0] == "admin":
@@ -533,187 +1407,483 @@ def reset_password(user_id):
 
 
 
-# -------------------- Top Damaged --------------------
-def get_top_damaged(search=None, start_date=None, end_date=None, damage_only=False, damage_filter=None, limit=10):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    sql = """SELECT machine_no, COUNT(*) as cnt
-             FROM records
-             WHERE 1=1 """
-    params = []
-
-    # filter: ค้นหาข้อความ
-    if search:
-        sql += " AND (machine_no LIKE ? OR name LIKE ? OR comments LIKE ? OR damage LIKE ?)"
-        like = f"%{search}%"
-        params += [like, like, like, like]
-
-    # filter: ช่วงวันที่
-    if start_date:
-        sql += " AND date_iso >= ?"
-        params.append(start_date)
-    if end_date:
-        sql += " AND date_iso <= ?"
-        params.append(end_date)
-
-    # filter: เฉพาะที่มีปัญหา
-    if damage_only:
-        sql += " AND damage IS NOT NULL AND damage <> ''"
-
-    # filter: จาก top issues
-    if damage_filter:
-        sql += " AND damage LIKE ?"
-        params.append(f"%{damage_filter}%")
-
-    sql += " GROUP BY machine_no ORDER BY cnt DESC LIMIT ?"
-    params.append(limit)
-
-    rows = c.execute(sql, params).fetchall()
-    conn.close()
-    return rows
+# -------------------- Full-text search --------------------
+FTS_MIN_CHARS = 3   # trigram ต้องมีอย่างน้อย 3 ตัวอักษรถึงจะใช้ index ได้
 
+def search_clause(search):
+    """
+    เงื่อนไขค้นหาข้อความ (machine_no/name/comments/damage) สำหรับต่อท้าย WHERE ของตาราง records
+    คืนค่า (sql, params)
+    """
+    if FTS_ENABLED and len(search) >= FTS_MIN_CHARS:
+        # ครอบเป็น phrase → ตรงกับ substring ทั้งก้อน และกันอักขระพิเศษของ FTS5 query
+        phrase = '"' + search.replace('"', '""') + '"'
+        return " AND id IN (SELECT rowid FROM records_fts WHERE records_fts MATCH ?)", [phrase]
+    like = f"%{search}%"
+    return (" AND (machine_no LIKE ? OR name LIKE ? OR comments LIKE ? OR damage LIKE ?)",
+            [like, like, like, like])
+
+
+# -------------------- Query cache --------------------
+# cache ผลลัพธ์ query ของ dashboard ใน process (LRU) — key รวม data_version
+# ทุก insert/edit/delete/restore ทำให้ data_version เปลี่ยน → entry เก่าไม่ถูกใช้อีกและค่อย ๆ ถูกไล่ออก
+QUERY_CACHE_MAX_ENTRIES = 512
+QUERY_CACHE_MAX_BYTES = 32 * 1024 * 1024
+QUERY_CACHE_MAX_ITEM_BYTES = 2 * 1024 * 1024   # ผลลัพธ์ใหญ่กว่านี้ (เช่น export) ไม่เก็บ
+
+def get_data_version(conn=None):
+    row = (conn or get_db()).execute(
+        "SELECT value FROM app_meta WHERE key = 'data_version'").fetchone()
+    return row[0] if row else 0
+
+def _approx_size(obj):
+    """ประมาณขนาดหน่วยความจำ (bytes) ของผลลัพธ์ query: tuple/list/dict ของ str/int"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        size += sum(_approx_size(x) for x in obj)
+    elif isinstance(obj, dict):
+        size += sum(_approx_size(k) + _approx_size(v) for k, v in obj.items())
+    return size
+
+class QueryCache:
+    def __init__(self, max_entries, max_bytes, max_item_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self._data = OrderedDict()   # key → (value, size)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item
+
+    def put(self, key, value):
+        size = _approx_size(value)
+        if size > self.max_item_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._data[key] = (value, size)
+            self.bytes += size
+            while self._data and (len(self._data) > self.max_entries or self.bytes > self.max_bytes):
+                _, (_, evicted) = self._data.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self.bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+            }
 
+query_cache = QueryCache(QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_MAX_BYTES, QUERY_CACHE_MAX_ITEM_BYTES)
 
-#==================================================
-#                       INDEX
-# =================================================
+def cached_query(fn):
+    """
+    cache ผลลัพธ์ตาม (ชื่อฟังก์ชัน, args, data_version)
+    args ต้อง hashable (RecordFilter เป็น frozen dataclass) และห้ามแก้ไขค่าที่คืนกลับไป
+    """
+    @wraps(fn)
+    def wrapped(*args, **kwargs):
+        key = (fn.__name__, args, tuple(sorted(kwargs.items())), get_data_version())
+        item = query_cache.get(key)
+        if item is not None:
+            return item[0]
+        value = fn(*args, **kwargs)
+        query_cache.put(key, value)
+        return value
+    return wrapped
 
-@app.route("/", methods=["GET","POST"])
-@login_required
-def index():
-    if request.method=="POST":
-        files = request.files.getlist("files")
-        file_paths = []
-        for file in files:
-            if file and file.filename and allowed_file(file.filename):
-                file.seek(0, os.SEEK_END)
-                size = file.tell()
-                file.seek(0)
-                if size > MAX_FILE_SIZE:
-                    flash(f"❌ ไฟล์ {file.filename} ใหญ่เกิน 20MB", "danger")
-                    return redirect(url_for("index"))
-                fname = secure_filename(file.filename)
-                save_path = os.path.join(UPLOAD_DIR, fname)
-                if os.path.exists(save_path):
-                    base, ext = os.path.splitext(fname)
-                    fname = f"{base}_{int(datetime.now().timestamp())}{ext}"
-                    save_path = os.path.join(UPLOAD_DIR, fname)
-                file.save(save_path)
-                file_paths.append(fname)
-        file_path_str = ";".join(file_paths) if file_paths else None
-        with sqlite3.connect(DB_NAME) as conn:
-            c = conn.cursor()
-            c.execute("""INSERT INTO records(machine_no,name,date_text,date_iso,comments,damage,file_path,created_by,created_at_iso)
-                         VALUES(?,?,?,?,?,?,?,?,?)""",
-                    (request.form["machine_no"].strip(),
-                     request.form["name"].strip(),
-                     parse_iso_to_text(parse_thai_date_to_iso(request.form["date_iso"])),   # 👈 ใช้ format ไทย → ISO → text
-                     parse_thai_date_to_iso(request.form["date_iso"]),                      # 👈 เก็บเป็น yyyy-mm-dd
-                     request.form.get("comments","").strip(),
-                     request.form.get("damage","").strip(),
-                     file_path_str,
-                     session["username"],
-                     datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
 
-            conn.commit()
-        flash("✅ Saved", "success")
-        return redirect(url_for("index"))
+# -------------------- Filters --------------------
+@dataclass(frozen=True)
+class RecordFilter:
+    """
+    ตัวกรองชุดเดียวที่ทุก query ใช้ร่วมกัน (ตาราง records, หน้า index, export)
+    date_filter = คลิกจุดใน Trend (?date_iso=), damage_filter = คลิก Top 5 ปัญหา (?damage_word=)
+    """
+    search: Optional[str] = None
+    start_date: Optional[str] = None
+    end_date: Optional[str] = None
+    damage_only: bool = False
+    date_filter: Optional[str] = None
+    damage_filter: Optional[str] = None
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(
+            search=args.get("search") or None,
+            start_date=args.get("start_date") or None,
+            end_date=args.get("end_date") or None,
+            damage_only=bool(args.get("damage_only")),
+            date_filter=args.get("date_iso") or None,
+            damage_filter=args.get("damage_word") or None,
+        )
+
+    @property
+    def rollups_ok(self):
+        return rollups_allowed(self.search, self.damage_filter)
+
+    def where(self, date_filter=True, default_start=None):
+        """
+        คืน (" WHERE ...", params) สำหรับตาราง records
+        date_filter=False: ไม่ใช้ ?date_iso= (กราฟ Top 10 / Trend ต้องเห็นทุกวันในช่วง)
+        default_start: นิพจน์ SQL ของวันเริ่มต้นเมื่อไม่ได้เลือก start_date (Trend = 30 วันล่าสุด)
+        """
+        sql = " WHERE 1=1"
+        params = []
+
+        # ค้นหาด้วยข้อความ
+        if self.search:
+            clause, clause_params = search_clause(self.search)
+            sql += clause
+            params += clause_params
+
+        # ช่วงวันที่
+        if self.start_date:
+            sql += " AND date_iso >= ?"
+            params.append(self.start_date)
+        elif default_start:
+            sql += f" AND date_iso >= {default_start}"
+        if self.end_date:
+            sql += " AND date_iso <= ?"
+            params.append(self.end_date)
+
+        # เฉพาะที่มีปัญหา
+        if self.damage_only:
+            sql += " AND damage IS NOT NULL AND damage <> ''"
+
+        # ✅ filter จาก Trend Chart
+        if date_filter and self.date_filter:
+            sql += " AND date_iso = ?"
+            params.append(self.date_filter)
+
+        # ✅ filter จาก Top 5 ปัญหา
+        if self.damage_filter:
+            clause, clause_params = damage_term_clause(self.damage_filter)
+            sql += clause
+            params += clause_params
+
+        return sql, params
+
+    def rollup_where(self, date_filter=True, default_start=None):
+        """เหมือน where() แต่สำหรับตาราง rollup (มีแค่ date_iso) — ใช้เมื่อ rollups_ok"""
+        sql = " WHERE 1=1"
+        params = []
+        if self.start_date:
+            sql += " AND date_iso >= ?"
+            params.append(self.start_date)
+        elif default_start:
+            sql += f" AND date_iso >= {default_start}"
+        if self.end_date:
+            sql += " AND date_iso <= ?"
+            params.append(self.end_date)
+        if date_filter and self.date_filter:
+            sql += " AND date_iso = ?"
+            params.append(self.date_filter)
+        return sql, params
+
+
+TREND_DEFAULT_START = "date('now','-30 day')"   # Trend ไม่เลือกช่วง = 30 วันล่าสุด
+
+@contextmanager
+def read_snapshot():
+    """
+    อ่านหลาย query ภายใน read transaction เดียว (WAL) → ทุก panel เห็นข้อมูลชุดเดียวกัน
+    ถ้ามี transaction เปิดอยู่แล้วจะใช้ต่อ
+    """
+    conn = get_db()
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN")
+    try:
+        yield conn
+    finally:
+        conn.rollback()   # อ่านอย่างเดียว ไม่มีอะไรต้อง commit
 
-    search = request.args.get("search")
-    start_date = request.args.get("start_date")
-    end_date = request.args.get("end_date")
-    damage_only = bool(request.args.get("damage_only"))
-    page = int(request.args.get("page", 1))
-    per_page = int(request.args.get("per_page", 20))   # 👈 ค่า default = 20
-    date_filter = request.args.get("date_iso")
-    damage_filter = request.args.get("damage_word")
-    recs, total = get_records(search, start_date, end_date, damage_only, page, per_page,
-                          date_filter=date_filter, damage_filter=damage_filter)
-
-    total_pages = (total + per_page - 1) // per_page  # ปัดเศษขึ้น
-
-    # ========== Chart: Top 10 damaged machines (ผูก filter) ==========
-    top_damaged = get_top_damaged(
-        search=search,
-        start_date=start_date,
-        end_date=end_date,
-        damage_only=damage_only,
-        damage_filter=damage_filter,
-        limit=10
-    )
-    labels = [r[0] for r in top_damaged]
-    counts = [r[1] for r in top_damaged]
 
-    # ========== Dashboard Queries ==========
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+# -------------------- Top Damaged --------------------
+@cached_query
+def get_top_damaged(flt, limit=10):
+    c = get_db().cursor()
+
+    if flt.rollups_ok:
+        # อ่านจาก rollup: ต้นทุนตามจำนวน (รถ × วัน) ในช่วง ไม่ใช่จำนวน record ทั้งหมด
+        col = "damaged" if flt.damage_only else "total"
+        where, params = flt.rollup_where(date_filter=False)
+        sql = (f"SELECT machine_no, SUM({col}) AS cnt FROM records_machine_daily{where}"
+               " GROUP BY machine_no HAVING cnt > 0 ORDER BY cnt DESC LIMIT ?")
+        return c.execute(sql, params + [limit]).fetchall()
+
+    where, params = flt.where(date_filter=False)
+    sql = f"SELECT machine_no, COUNT(*) as cnt FROM records{where} GROUP BY machine_no ORDER BY cnt DESC LIMIT ?"
+    return c.execute(sql, params + [limit]).fetchall()
+
+
+# -------------------- Dashboard --------------------
+@cached_query
+def get_dashboard_counts(today):
+    """(จำนวนตรวจวันนี้, จำนวนที่พบปัญหา, จำนวนทั้งหมด) จาก rollup รายวัน"""
+    c = get_db().cursor()
+    row = c.execute("SELECT total FROM records_daily WHERE date_iso = ?", (today,)).fetchone()
+    total_today = row[0] if row else 0
+    total_all, total_with_damage = c.execute(
+        "SELECT IFNULL(SUM(total), 0), IFNULL(SUM(damaged), 0) FROM records_daily").fetchone()
+    return total_today, total_with_damage, total_all
+
+@cached_query
+def get_top_issues(flt, limit=5):
+    # ใช้แค่ค้นหา/ช่วงวันที่ — ไม่ผูก damage_word เพื่อให้ยังคลิกสลับคำอื่นได้
+    c = get_db().cursor()
+    sql = "SELECT term, COUNT(*) AS cnt FROM damage_terms"
+    params = []
+    if flt.search or flt.start_date or flt.end_date:
+        where, params = RecordFilter(flt.search, flt.start_date, flt.end_date).where()
+        sql += f" WHERE record_id IN (SELECT id FROM records{where})"
+    sql += " GROUP BY term ORDER BY cnt DESC, term LIMIT ?"
+    return c.execute(sql, params + [limit]).fetchall()
+
+@cached_query
+def get_trend(flt):
+    c = get_db().cursor()
+
+    if flt.rollups_ok:
+        col = "damaged" if flt.damage_only else "total"
+        where, params = flt.rollup_where(date_filter=False, default_start=TREND_DEFAULT_START)
+        sql = f"SELECT date_iso, {col} FROM records_daily{where} AND {col} > 0 ORDER BY date_iso"
+        return c.execute(sql, params).fetchall()
+
+    where, params = flt.where(date_filter=False, default_start=TREND_DEFAULT_START)
+    sql = f"SELECT date_iso, COUNT(*) FROM records{where} GROUP BY date_iso ORDER BY date_iso"
+    return c.execute(sql, params).fetchall()
+
+@cached_query
+def count_records(flt):
+    """จำนวน record ที่ตรง filter; ใช้ rollup ได้ถ้าไม่มีตัวกรองข้อความ"""
+    c = get_db().cursor()
+    if flt.rollups_ok:
+        col = "damaged" if flt.damage_only else "total"
+        where, params = flt.rollup_where()
+        return c.execute(f"SELECT IFNULL(SUM({col}), 0) FROM records_daily{where}", params).fetchone()[0]
+    where, params = flt.where()
+    return c.execute(f"SELECT COUNT(*) FROM records{where}", params).fetchone()[0]
+
+@cached_query
+def _scan_panels(flt, limit):
+    """
+    กรณีมีตัวกรองข้อความ (rollup ใช้ไม่ได้): สแกน records ครั้งเดียวผ่าน CTE แล้วแตกเป็น
+    จำนวนทั้งหมด + Top รถ + Trend ในคำสั่งเดียว
+    """
+    where, params = flt.where(date_filter=False)
+    trend_cond = "1=1" if flt.start_date else f"date_iso >= {TREND_DEFAULT_START}"
+    total_cond, total_params = ("date_iso = ?", [flt.date_filter]) if flt.date_filter else ("1=1", [])
+    sql = f"""
+        WITH matched AS (SELECT machine_no, date_iso FROM records{where})
+        SELECT 'total', NULL, COUNT(*) FROM matched WHERE {total_cond}
+        UNION ALL
+        SELECT 'machine', machine_no, cnt FROM (
+            SELECT machine_no, COUNT(*) AS cnt FROM matched GROUP BY machine_no ORDER BY cnt DESC LIMIT ?)
+        UNION ALL
+        SELECT 'trend', date_iso, cnt FROM (
+            SELECT date_iso, COUNT(*) AS cnt FROM matched WHERE {trend_cond} GROUP BY date_iso)
+    """
+    total, top_damaged, trend = 0, [], []
+    for kind, key, cnt in get_db().execute(sql, params + total_params + [limit]):
+        if kind == "total":
+            total = cnt
+        elif kind == "machine":
+            top_damaged.append((key, cnt))
+        else:
+            trend.append((key, cnt))
+    top_damaged.sort(key=lambda r: -r[1])
+    trend.sort()
+    return total, top_damaged, trend
 
-    # จำนวนตรวจวันนี้
+def query_dashboard(flt, page=1, per_page=20, sort_by="created", after=None, before=None,
+                    count_mode="exact", top_machines=10, top_issues=5):
+    """
+    ข้อมูลทั้งหมดของหน้า index ใน read transaction เดียว:
+    หน้า records, จำนวนทั้งหมด, Top รถ, Trend, Top ปัญหา และตัวเลข dashboard
+    """
     today = datetime.now().strftime("%Y-%m-%d")
-    c.execute("SELECT COUNT(*) FROM records WHERE date_iso = ?", (today,))
-    total_today = c.fetchone()[0]
-
-    # % รถที่พบปัญหา
-    c.execute("SELECT COUNT(*) FROM records WHERE damage IS NOT NULL AND damage != ''")
-    total_with_damage = c.fetchone()[0]
-
-    c.execute("SELECT COUNT(*) FROM records")
-    total_all = c.fetchone()[0]
+    with read_snapshot():
+        recs, _ = get_records(flt, page, per_page, sort_by=sort_by,
+                              after=after, before=before, count_mode="none")
+        if flt.rollups_ok:
+            total = count_records(flt) if count_mode != "none" else None
+            top_damaged = get_top_damaged(flt, limit=top_machines)
+            trend = get_trend(flt)
+        else:
+            total, top_damaged, trend = _scan_panels(flt, top_machines)
+            if count_mode == "none":
+                total = None
+        return {
+            "recs": recs,
+            "total": total,
+            "top_damaged": top_damaged,
+            "trend": trend,
+            "top_issues": get_top_issues(flt, limit=top_issues),
+            "counts": get_dashboard_counts(today),
+        }
 
-    percent_damage = round((total_with_damage / total_all * 100), 1) if total_all else 0
 
-    # Top 5 ปัญหาที่พบบ่อย
-    c.execute("SELECT damage FROM records WHERE damage IS NOT NULL AND damage != ''")
-    damages = [row[0] for row in c.fetchall()]
-    conn.close()
+#==================================================
+#                       INDEX
+# =================================================
 
-    from collections import Counter
-    words = []
-    for d in damages:
-        words.extend(d.split())
-    top_issues = Counter(words).most_common(5)
+# ส่วนที่ถูก swap แทนที่ในหน้าโดยไม่ reload (ดู /fragments/...) → หน้าเต็มกับ fragment ใช้ template ชุดเดียวกัน
+register_template("index_records_rows.html", """    {% for r in recs %}
+    <tr>
+      <td>{{r[1]}}</td><td>{{r[2]}}</td><td>{{r[3]}}</td><td>{{ r[5] or "—" }}</td><td>{{r[6] or "-"}}</td>
+      <td class="text-center">
+  {% if r[10] %}
+    <a href="#" data-bs-toggle="modal" data-bs-target="#filesModal" data-record-id="{{r[0]}}"
+       data-files-url="{{ url_for('record_files', record_id=r[0]) }}"
+       title="{{ (r[11] / 1048576)|round(1) }} MB">
+      📎 {{ r[10] }}
+    </a>
+  {% endif %}
+</td>
 
-    # ✅ แปลงวันที่สำหรับแสดงผล
-    today_text = datetime.now().strftime("%d/%m/%Y")
+      <td>{{r[7]}}</td><td>{{r[8]}}</td>
+      <td>
+          {% if session['role'] == 'admin' %}
+            <a href="{{url_for('edit',record_id=r[0])}}" class="btn btn-sm btn-warning">Edit</a>
+            <a href="{{url_for('delete',record_id=r[0])}}" onclick="return confirm('Delete?')" class="btn btn-sm btn-danger">Delete</a>
+          {% else %}
+            <span class="text-muted">View Only</span>
+          {% endif %}
+    </td>
 
-    # ========== Trend (30 วันล่าสุด) พร้อม filter ==========
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    sql = "SELECT date_iso, COUNT(*) FROM records WHERE 1=1"
-    params = []
+    </tr>
+    {% endfor %}
+""")
 
-    if search:
-        sql += " AND (machine_no LIKE ? OR name LIKE ? OR comments LIKE ? OR damage LIKE ?)"
-        like = f"%{search}%"
-        params += [like, like, like, like]
+register_template("index_pager.html", """<!-- ✅ Pagination (แสดงเฉพาะหน้ารอบ ๆ หน้าปัจจุบัน + หน้าแรก/หน้าสุดท้าย) -->
+{% macro page_url(p, after=None, before=None) -%}
+  {{ url_for('index', page=p, after=after, before=before,
+             per_page=request.args.get('per_page','20'),
+             sort_by=sort_by,
+             count=request.args.get('count'),
+             search=request.args.get('search'),
+             start_date=request.args.get('start_date'),
+             end_date=request.args.get('end_date'),
+             damage_only=request.args.get('damage_only'),
+             date_iso=request.args.get('date_iso'),
+             damage_word=request.args.get('damage_word')) }}
+{%- endmacro %}
+<nav>
+  <ul class="pagination justify-content-center flex-wrap">
+    <!-- Previous -->
+    <li class="page-item {% if page <= 1 %}disabled{% endif %}">
+      <a class="page-link" href="{{ page_url(page-1, before=prev_cursor) }}">Previous</a>
+    </li>
 
-    if start_date:
-        sql += " AND date_iso >= ?"
-        params.append(start_date)
-    else:
-        sql += " AND date_iso >= date('now','-30 day')"  # default 30 วัน
+    <!-- Numbered pages -->
+    {% for p in page_links %}
+      {% if p is none %}
+      <li class="page-item disabled"><span class="page-link">…</span></li>
+      {% else %}
+      <li class="page-item {% if p == page %}active{% endif %}">
+        <a class="page-link" href="{{ page_url(p) }}">{{p}}</a>
+      </li>
+      {% endif %}
+    {% endfor %}
 
-    if end_date:
-        sql += " AND date_iso <= ?"
-        params.append(end_date)
+    <!-- Next -->
+    <li class="page-item {% if page >= total_pages %}disabled{% endif %}">
+      <a class="page-link" href="{{ page_url(page+1, after=next_cursor) }}">Next</a>
+    </li>
+  </ul>
+</nav>
+""")
 
-    if damage_only:
-        sql += " AND damage IS NOT NULL AND damage <> ''"
+register_template("index_total.html",
+    """{{ total if total is not none else '—' }}{% if total_capped %}+{% endif %}""")
 
-    if damage_filter:
-        sql += " AND damage LIKE ?"
-        params.append(f"%{damage_filter}%")
+register_template("index_filter_summary.html", """    {% if request.args.get('start_date') %}
+      <span class="badge text-bg-light border">เริ่ม: {{ request.args.get('start_date') }}</span>
+    {% endif %}
+    {% if request.args.get('end_date') %}
+      <span class="badge text-bg-light border">สิ้นสุด: {{ request.args.get('end_date') }}</span>
+    {% endif %}
+    {% if request.args.get('search') %}
+      <span class="badge text-bg-light border">ค้นหา: {{ request.args.get('search') }}</span>
+    {% endif %}
+    {% if request.args.get('damage_only') %}
+      <span class="badge text-bg-light border">เฉพาะที่เสียหาย</span>
+    {% endif %}
+""")
 
-    sql += " GROUP BY date_iso ORDER BY date_iso"
-    c.execute(sql, params)
-    trend_data = c.fetchall()
-    conn.close()
+register_template("index_export_buttons.html", """    <a href="{{ url_for('export_excel', search=request.args.get('search'),
+                                      start_date=request.args.get('start_date'),
+                                      end_date=request.args.get('end_date'),
+                                      damage_only=request.args.get('damage_only'),
+                                      per_page=request.args.get('per_page','20'),
+                                      sort_by=request.args.get('sort_by','created')) }}"
+       class="btn btn-success btn-sm">📊 Excel</a>
+    <a href="{{ url_for('export_csv', search=request.args.get('search'),
+                                    start_date=request.args.get('start_date'),
+                                    end_date=request.args.get('end_date'),
+                                    damage_only=request.args.get('damage_only'),
+                                    per_page=request.args.get('per_page','20'),
+                                    sort_by=request.args.get('sort_by','created')) }}"
+       class="btn btn-info btn-sm">📄 CSV</a>
+    <a href="{{ url_for('export_pdf', search=request.args.get('search'),
+                                    start_date=request.args.get('start_date'),
+                                    end_date=request.args.get('end_date'),
+                                    damage_only=request.args.get('damage_only'),
+                                    per_page=request.args.get('per_page','20'),
+                                    sort_by=request.args.get('sort_by','created')) }}"
+       class="btn btn-danger btn-sm">📑 PDF</a>
+    <a href="{{ url_for('export_sheets', search=request.args.get('search'),
+                                       start_date=request.args.get('start_date'),
+                                       end_date=request.args.get('end_date'),
+                                       damage_only=request.args.get('damage_only'),
+                                       sort_by=request.args.get('sort_by','created')) }}"
+       class="btn btn-outline-danger btn-sm">🗂️ ใบตรวจ (ZIP)</a>
+    <a href="{{ url_for('export_attachments', search=request.args.get('search'),
+                                            start_date=request.args.get('start_date'),
+                                            end_date=request.args.get('end_date'),
+                                            damage_only=request.args.get('damage_only'),
+                                            sort_by=request.args.get('sort_by','created')) }}"
+       class="btn btn-outline-secondary btn-sm">📎 ไฟล์แนบ (ZIP)</a>
+""")
 
-    trend_labels = [row[0] for row in trend_data]
-    trend_counts = [row[1] for row in trend_data]
+register_template("index_top_issues.html", """           {% for issue,count in top_issues %}
+            <li>
+              <a href="?damage_word={{ issue }}" class="text-decoration-none">
+                {{ issue }} ({{ count }})
+              </a>
+            </li>
+            {% endfor %}
+""")
 
-    
-    return render_template_string(THEME_CSS + """
+register_template("index_page.html", """{% include "theme.html" %}
 
 <!doctype html>
 
@@ -885,19 +2055,8 @@ def index():
   </div>
 
   <!-- สรุปตัวกรอง -->
-  <div class="mt-1 small d-flex flex-wrap gap-1">
-    {% if request.args.get('start_date') %}
-      <span class="badge text-bg-light border">เริ่ม: {{ request.args.get('start_date') }}</span>
-    {% endif %}
-    {% if request.args.get('end_date') %}
-      <span class="badge text-bg-light border">สิ้นสุด: {{ request.args.get('end_date') }}</span>
-    {% endif %}
-    {% if request.args.get('search') %}
-      <span class="badge text-bg-light border">ค้นหา: {{ request.args.get('search') }}</span>
-    {% endif %}
-    {% if request.args.get('damage_only') %}
-      <span class="badge text-bg-light border">เฉพาะที่เสียหาย</span>
-    {% endif %}
+  <div id="filterSummary" class="mt-1 small d-flex flex-wrap gap-1">
+    {% include "index_filter_summary.html" %}
   </div>
 </div>
               </div>
@@ -916,35 +2075,15 @@ def index():
   <div class="alert shadow-sm border-0 rounded-pill py-2 px-4 d-flex align-items-center"
        style="background: linear-gradient(90deg, #0d6efd 0%, #0dcaf0 100%); color: #fff; font-size: 1.1rem; font-weight: 600;">
     <i class="bi bi-search me-2"></i>
-    พบข้อมูลทั้งหมด <span class="mx-1">{{ total }}</span> รายการ
+    พบข้อมูลทั้งหมด <span class="mx-1" id="recordsTotal">{% include "index_total.html" %}</span> รายการ
   </div>
 </div>
 
 <!-- บรรทัดล่าง: Export -->
   <div class="d-flex justify-content-between align-items-center mt-2 flex-wrap gap-2">
   <!-- Export buttons (top only) -->
-  <div class="btn-group">
-    <a href="{{ url_for('export_excel', search=request.args.get('search'),
-                                      start_date=request.args.get('start_date'),
-                                      end_date=request.args.get('end_date'),
-                                      damage_only=request.args.get('damage_only'),
-                                      per_page=request.args.get('per_page','20'),
-                                      sort_by=request.args.get('sort_by','created')) }}"
-       class="btn btn-success btn-sm">📊 Excel</a>
-    <a href="{{ url_for('export_csv', search=request.args.get('search'),
-                                    start_date=request.args.get('start_date'),
-                                    end_date=request.args.get('end_date'),
-                                    damage_only=request.args.get('damage_only'),
-                                    per_page=request.args.get('per_page','20'),
-                                    sort_by=request.args.get('sort_by','created')) }}"
-       class="btn btn-info btn-sm">📄 CSV</a>
-    <a href="{{ url_for('export_pdf', search=request.args.get('search'),
-                                    start_date=request.args.get('start_date'),
-                                    end_date=request.args.get('end_date'),
-                                    damage_only=request.args.get('damage_only'),
-                                    per_page=request.args.get('per_page','20'),
-                                    sort_by=request.args.get('sort_by','created')) }}"
-       class="btn btn-danger btn-sm">📑 PDF</a>
+  <div class="btn-group" id="exportButtons">
+    {% include "index_export_buttons.html" %}
   </div>
 
 
@@ -1084,14 +2223,8 @@ def index():
     <div class="col-md-4">
       <div class="card dashboard-card">
         <h6>Top 5 ปัญหาที่พบบ่อย</h6>
-          <ul class="list-unstyled mb-0">
-           {% for issue,count in top_issues %}
-            <li>
-              <a href="?damage_word={{ issue }}" class="text-decoration-none">
-                {{ issue }} ({{ count }})
-              </a>
-            </li>
-            {% endfor %}
+          <ul class="list-unstyled mb-0" id="topIssues">
+            {% include "index_top_issues.html" %}
           </ul>
         </div>
     </div>
@@ -1128,22 +2261,121 @@ def index():
 </script>
 
 <script>
-document.addEventListener("DOMContentLoaded", function() {
-  const sortDropdowns = document.querySelectorAll("select[name='sort_by']");
-  sortDropdowns.forEach(function(dd) {
-    dd.addEventListener("change", function() {
-      if (this.form) {
-        // ถ้ามี form → submit ปกติ
-        this.form.submit();
-      } else {
-        // ถ้าอยู่นอก form → redirect ไปพร้อม query string
-        const url = new URL(window.location.href);
-        url.searchParams.set("sort_by", this.value);
-        window.location.href = url.toString();
-      }
+// ✅ Partial update: เปลี่ยน sort/หน้า/filter แล้ว swap เฉพาะตาราง + pager + กราฟ (ไม่ reload ทั้งหน้า)
+//    URL ยังตรงกับสิ่งที่แสดงเสมอ (pushState) → refresh / bookmark / ปุ่ม Back ได้ผลเหมือนเดิม
+(function(){
+  // พารามิเตอร์ที่กระทบแค่ตาราง → ขอ /fragments/records (query หน้าเดียว)
+  const RECORD_ONLY = ['page', 'after', 'before', 'sort_by', 'per_page', 'count'];
+  const FRAGMENTS = {
+    records: "{{ url_for('fragment_records') }}",
+    dashboard: "{{ url_for('fragment_dashboard') }}",
+  };
+  let shown = new URL(window.location.href);
+  let pending = null;
+
+  function filtersChanged(a, b){
+    const keys = new Set([...a.searchParams.keys(), ...b.searchParams.keys()]);
+    for (const k of keys){
+      if (RECORD_ONLY.includes(k)) continue;
+      if ((a.searchParams.get(k) || '') !== (b.searchParams.get(k) || '')) return true;
+    }
+    return false;
+  }
+
+  function syncForm(url){
+    const p = url.searchParams;
+    document.querySelectorAll("select[name='sort_by']").forEach(el => { el.value = p.get('sort_by') || 'created'; });
+    document.querySelectorAll("select[name='per_page']").forEach(el => { el.value = p.get('per_page') || '20'; });
+    ['search', 'start_date', 'end_date'].forEach(name => {
+      document.querySelectorAll(`input[name='${name}']`).forEach(el => { el.value = p.get(name) || ''; });
+    });
+    document.querySelectorAll("input[name='damage_only']").forEach(el => { el.checked = !!p.get('damage_only'); });
+    if (window.decorateRangeButton) window.decorateRangeButton();
+  }
+
+  function swap(data){
+    document.getElementById('recordsBody').innerHTML = data.rows;
+    document.getElementById('recordsPager').innerHTML = data.pager;
+    document.getElementById('recordsTotal').innerHTML = data.total;
+    document.getElementById('filterSummary').innerHTML = data.summary;
+    document.getElementById('exportButtons').innerHTML = data.exports;
+    if (data.top_issues !== undefined){
+      document.getElementById('topIssues').innerHTML = data.top_issues;
+      chartData.labels = data.damage_chart.labels;
+      chartData.datasets[0].data = data.damage_chart.counts;
+      myChart.update();
+      trendChart.data.labels = data.trend_chart.labels;
+      trendChart.data.datasets[0].data = data.trend_chart.counts;
+      trendChart.update();
+    }
+  }
+
+  function navigate(href, push=true){
+    const url = new URL(href, window.location.href);
+    const kind = filtersChanged(shown, url) ? 'dashboard' : 'records';
+    if (pending) pending.abort();
+    const ctrl = pending = new AbortController();
+    return fetch(FRAGMENTS[kind] + url.search, {signal: ctrl.signal, headers: {'Accept': 'application/json'}})
+      .then(res => {
+        if (!res.ok || res.redirected) throw new Error(res.status);   // session หมด → หน้า login
+        return res.json();
+      })
+      .then(data => {
+        swap(data);
+        shown = url;
+        if (push) history.pushState({}, '', url);
+        syncForm(url);
+      })
+      .catch(err => {
+        if (err.name !== 'AbortError') window.location.href = url.toString();   // fallback: โหลดทั้งหน้า
+      })
+      .finally(() => { if (pending === ctrl) pending = null; });
+  }
+  window.navigateIndex = navigate;
+
+  function withParams(changes){
+    const url = new URL(window.location.href);
+    Object.entries(changes).forEach(([k, v]) => v == null ? url.searchParams.delete(k) : url.searchParams.set(k, v));
+    ['page', 'after', 'before'].forEach(k => url.searchParams.delete(k));   // reset pagination
+    return url;
+  }
+  window.indexUrlWith = withParams;
+
+  window.addEventListener('popstate', () => navigate(window.location.href, false));
+
+  document.addEventListener("DOMContentLoaded", function() {
+    // sort / per_page → หน้าแรกของลำดับใหม่ (ทั้ง dropdown ใน form และตัวที่อยู่นอก form)
+    document.querySelectorAll("select[name='sort_by'], select[name='per_page']").forEach(function(dd) {
+      dd.addEventListener("change", function() {
+        navigate(withParams({[this.name]: this.value}));
+      });
+    });
+
+    // ปุ่ม Search / Apply ของ header form
+    document.querySelectorAll("form[method='get']").forEach(function(form) {
+      form.addEventListener("submit", function(ev) {
+        ev.preventDefault();
+        const url = new URL(form.action || window.location.href, window.location.href);
+        url.search = new URLSearchParams(
+          [...new FormData(form)].filter(([, v]) => v !== '')).toString();
+        const adv = document.getElementById('advFilters');
+        const oc = adv && bootstrap.Offcanvas.getInstance(adv);
+        if (oc) oc.hide();
+        navigate(url);
+      });
+    });
+
+    // pager + Top 5 ปัญหา (ลิงก์ถูก swap ใหม่ได้ → ผูกที่ container)
+    ['recordsPager', 'topIssues'].forEach(function(id) {
+      document.getElementById(id).addEventListener("click", function(ev) {
+        const a = ev.target.closest("a[href]");
+        if (!a || a.closest('.disabled') || ev.ctrlKey || ev.metaKey || ev.shiftKey) return;
+        ev.preventDefault();
+        navigate(a.href);
+      });
     });
   });
-});
+})();
 </script>
 
        
@@ -1181,119 +2413,87 @@ function toggleAdvanced() {
     adv.classList.remove("d-none");
     adv.classList.add("show");
     btn.textContent = "Basic ▲";
-  } else {
-    adv.classList.remove("show");
-    setTimeout(() => adv.classList.add("d-none"), 300); // รอ animation จบค่อยซ่อน
-    btn.textContent = "Advanced ▼";
-  }
-}
-</script>
-
-<table class="table table-bordered table-hover shadow-sm align-middle">
-  <thead class="table-dark text-center">
-    <tr><th>Machine No.</th><th>Name</th><th>Date</th><th>Comments</th>
-    <th>List Damage</th><th>File</th><th>Created By</th><th>Created At</th><th>Action</th></tr>
-  </thead>
-  <tbody>
-    {% for r in recs %}
-    <tr>
-      <td>{{r[1]}}</td><td>{{r[2]}}</td><td>{{r[3]}}</td><td>{{ r[5] or "—" }}</td><td>{{r[6] or "-"}}</td>
-      <td class="text-center">
-  {% if r[9] %}
-    {% set files = r[9].split(';') %}
-    <a href="#" data-bs-toggle="modal" data-bs-target="#filesModal{{r[0]}}">
-      📎 {{ files|length }}
-    </a>
-
-    <!-- Modal -->
-    <div class="modal fade" id="filesModal{{r[0]}}" tabindex="-1" aria-hidden="true">
-      <div class="modal-dialog modal-dialog-centered">
-        <div class="modal-content">
-          <div class="modal-header">
-            <h5 class="modal-title">📎 Files for Record #{{r[0]}}</h5>
-            <button type="button" class="btn-close" data-bs-dismiss="modal" aria-label="Close"></button>
-          </div>
-          <div class="modal-body">
-            <ul class="list-group">
-              {% for f in files %}
-              <li class="list-group-item">
-                <a href="{{ url_for('uploaded_file', filename=f) }}" target="_blank">{{ f }}</a>
-              </li>
-              {% endfor %}
-            </ul>
-          </div>
-          <div class="modal-footer">
-            <button type="button" class="btn btn-secondary btn-sm" data-bs-dismiss="modal">ปิด</button>
-          </div>
-        </div>
-      </div>
-    </div>
-  {% endif %}
-</td>
-
-      <td>{{r[7]}}</td><td>{{r[8]}}</td>
-      <td>
-          {% if session['role'] == 'admin' %}
-            <a href="{{url_for('edit',record_id=r[0])}}" class="btn btn-sm btn-warning">Edit</a>
-            <a href="{{url_for('delete',record_id=r[0])}}" onclick="return confirm('Delete?')" class="btn btn-sm btn-danger">Delete</a>
-          {% else %}
-            <span class="text-muted">View Only</span>
-          {% endif %}
-    </td>
+  } else {
+    adv.classList.remove("show");
+    setTimeout(() => adv.classList.add("d-none"), 300); // รอ animation จบค่อยซ่อน
+    btn.textContent = "Advanced ▼";
+  }
+}
+</script>
 
-    </tr>
-    {% endfor %}
+<table class="table table-bordered table-hover shadow-sm align-middle">
+  <thead class="table-dark text-center">
+    <tr><th>Machine No.</th><th>Name</th><th>Date</th><th>Comments</th>
+    <th>List Damage</th><th>File</th><th>Created By</th><th>Created At</th><th>Action</th></tr>
+  </thead>
+  <tbody id="recordsBody">
+    {% include "index_records_rows.html" %}
   </tbody>
 </table>
 
-<!-- ✅ Pagination -->
-<nav>
-  <ul class="pagination justify-content-center">
-    <!-- Previous -->
-    <li class="page-item {% if page <= 1 %}disabled{% endif %}">
-      <a class="page-link"
-         href="{{ url_for('index',
-               page=page-1,
-               per_page=request.args.get('per_page','20'),
-               search=request.args.get('search'),
-               start_date=request.args.get('start_date'),
-               end_date=request.args.get('end_date'),
-               damage_only=request.args.get('damage_only')) }}">
-         Previous
-      </a>
-    </li>
-
-    <!-- Numbered pages -->
-    {% for p in range(1, total_pages+1) %}
-      <li class="page-item {% if p == page %}active{% endif %}">
-        <a class="page-link"
-           href="{{ url_for('index',
-                 page=p,
-                 per_page=request.args.get('per_page','20'),
-                 search=request.args.get('search'),
-                 start_date=request.args.get('start_date'),
-                 end_date=request.args.get('end_date'),
-                 damage_only=request.args.get('damage_only')) }}">
-           {{p}}
-        </a>
-      </li>
-    {% endfor %}
+<!-- Modal ไฟล์แนบ (ใช้ร่วมกันทุกแถว — โหลดรายการไฟล์เมื่อเปิดเท่านั้น) -->
+<div class="modal fade" id="filesModal" tabindex="-1" aria-hidden="true">
+  <div class="modal-dialog modal-dialog-centered">
+    <div class="modal-content">
+      <div class="modal-header">
+        <h5 class="modal-title">📎 Files for Record #<span id="filesModalRecord"></span></h5>
+        <button type="button" class="btn-close" data-bs-dismiss="modal" aria-label="Close"></button>
+      </div>
+      <div class="modal-body">
+        <ul class="list-group" id="filesModalList"></ul>
+      </div>
+      <div class="modal-footer">
+        <a class="btn btn-outline-primary btn-sm" id="filesModalZip" href="#">⬇️ ดาวน์โหลดทั้งหมด (ZIP)</a>
+        <button type="button" class="btn btn-secondary btn-sm" data-bs-dismiss="modal">ปิด</button>
+      </div>
+    </div>
+  </div>
+</div>
+<script>
+(function(){
+  const modal = document.getElementById('filesModal');
+  const list = document.getElementById('filesModalList');
+  modal.addEventListener('show.bs.modal', function(ev){
+    const trigger = ev.relatedTarget;
+    document.getElementById('filesModalRecord').textContent = trigger.getAttribute('data-record-id');
+    list.innerHTML = '<li class="list-group-item text-muted">กำลังโหลด...</li>';
+    fetch(trigger.getAttribute('data-files-url'))
+      .then(res => res.json())
+      .then(data => {
+        list.innerHTML = '';
+        document.getElementById('filesModalZip').href = data.zip_url;
+        data.files.forEach(f => {
+          const li = document.createElement('li');
+          li.className = 'list-group-item d-flex align-items-center gap-2';
+          const a = document.createElement('a');
+          a.href = f.url; a.target = '_blank';   // ต้นฉบับโหลดเมื่อคลิกเท่านั้น
+          if (f.thumb_url) {
+            // รูป → แสดงรูปย่อ (ไม่กี่ KB) แทนการโหลดรูปเต็มจากมือถือ
+            const img = document.createElement('img');
+            img.src = f.thumb_url; img.srcset = `${f.thumb_url} 1x, ${f.thumb_url_2x} 2x`;
+            img.alt = f.name; img.loading = 'lazy'; img.height = 80;
+            img.className = 'rounded border';
+            img.onerror = () => img.remove();
+            a.appendChild(img);
+            li.appendChild(a);
+            const name = document.createElement('a');
+            name.href = f.url; name.target = '_blank'; name.textContent = f.name;
+            li.appendChild(name);
+          } else {
+            a.textContent = f.name;
+            li.appendChild(a);
+          }
+          list.appendChild(li);
+        });
+      })
+      .catch(() => { list.innerHTML = '<li class="list-group-item text-danger">โหลดรายการไฟล์ไม่สำเร็จ</li>'; });
+  });
+})();
+</script>
 
-    <!-- Next -->
-    <li class="page-item {% if page >= total_pages %}disabled{% endif %}">
-      <a class="page-link"
-         href="{{ url_for('index',
-               page=page+1,
-               per_page=request.args.get('per_page','20'),
-               search=request.args.get('search'),
-               start_date=request.args.get('start_date'),
-               end_date=request.args.get('end_date'),
-               damage_only=request.args.get('damage_only')) }}">
-         Next
-      </a>
-    </li>
-  </ul>
-</nav>
+<div id="recordsPager">
+{% include "index_pager.html" %}
+</div>
 
 <!-- โหลด Flatpickr -->
 <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/flatpickr/dist/flatpickr.min.css">
@@ -1445,7 +2645,7 @@ document.getElementById("trendChart").onclick = function(evt) {
   if (points.length > 0) {
     const firstPoint = points[0];
     const label = trendChart.data.labels[firstPoint.index];
-    window.location.href = `?date_iso=${label}`;
+    navigateIndex(`?date_iso=${label}`);
   }
 };
 </script>
@@ -1537,11 +2737,7 @@ document.getElementById("trendChart").onclick = function(evt) {
 
   function applyRange(key){
     const {start, end} = getRange(key);
-    const url = new URL(window.location.href);
-    url.searchParams.set('start_date', toISO(start));
-    url.searchParams.set('end_date',   toISO(end));
-    url.searchParams.delete('page'); // reset pagination
-    window.location.href = url.toString();
+    navigateIndex(indexUrlWith({start_date: toISO(start), end_date: toISO(end)}));
   }
 
   // ----- Bind click events -----
@@ -1553,19 +2749,13 @@ document.getElementById("trendChart").onclick = function(evt) {
   });
 
   // ----- Decorate button label & active item (best-effort) -----
-  const url = new URL(window.location.href);
-  const s = url.searchParams.get('start_date');
-  const e = url.searchParams.get('end_date');
-  const btn = document.getElementById('rangeDropdownBtn');
-
   function formatRangeLabel(s, e){
     if (!s || !e) return 'วันที่ (ช่วงด่วน)';
     if (s === e) return `วันที่: ${s}`;
     return `${s} → ${e}`;
   }
-  if (btn) btn.textContent = formatRangeLabel(s, e);
 
-  function markActive(){
+  function markActive(s, e){
     const items = document.querySelectorAll('.dropdown-menu [data-range]');
     items.forEach(i => i.classList.remove('active'));
     if (!s || !e) return;
@@ -1596,7 +2786,17 @@ document.getElementById("trendChart").onclick = function(evt) {
       }
     }
   }
-  markActive();
+
+  // เรียกซ้ำหลัง partial update (URL เปลี่ยนแต่หน้าไม่ reload)
+  window.decorateRangeButton = function(){
+    const url = new URL(window.location.href);
+    const s = url.searchParams.get('start_date');
+    const e = url.searchParams.get('end_date');
+    const btn = document.getElementById('rangeDropdownBtn');
+    if (btn) btn.textContent = formatRangeLabel(s, e);
+    markActive(s, e);
+  };
+  decorateRangeButton();
 })();
 </script>
 
@@ -1657,230 +2857,949 @@ document.getElementById("trendChart").onclick = function(evt) {
 
 
 </div>
-""",recs=recs,
-    total=total,                          
-    page=page,
-    total_pages=total_pages,
-    labels=labels,
-    counts=counts,
+""")
+
+@app.route("/", methods=["GET","POST"])
+@login_required
+def index():
+    if request.method=="POST":
+        spooled = spool_uploads(request.files.getlist("files"))
+        if spooled is None:
+            return redirect(url_for("index"))
+        try:
+            with get_db() as conn:
+                c = conn.cursor()
+                c.execute("""INSERT INTO records(machine_no,name,date_text,date_iso,comments,damage,created_by,created_at_iso)
+                             VALUES(?,?,?,?,?,?,?,?)""",
+                        (request.form["machine_no"].strip(),
+                         request.form["name"].strip(),
+                         parse_iso_to_text(parse_thai_date_to_iso(request.form["date_iso"])),   # 👈 ใช้ format ไทย → ISO → text
+                         parse_thai_date_to_iso(request.form["date_iso"]),                      # 👈 เก็บเป็น yyyy-mm-dd
+                         request.form.get("comments","").strip(),
+                         request.form.get("damage","").strip(),
+                         session["username"],
+                         datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+                record_id = c.lastrowid
+                sync_damage_terms(c, record_id, request.form.get("damage","").strip())
+                for original_name, sp in spooled:
+                    store_upload(c, record_id, sp, original_name)
+
+                conn.commit()
+        except Exception:
+            discard_spooled(spooled)   # with get_db() rollback ให้แล้ว
+            raise
+        flash("✅ Saved", "success")
+        return redirect(url_for("index"))
+
+    flt = RecordFilter.from_args(request.args)
+    nav = parse_index_args(request.args)
+
+    # ทุก panel ใน read transaction เดียว (สแกน records ไม่เกินหนึ่งรอบ)
+    dash = query_dashboard(flt, nav["page"], nav["per_page"], sort_by=nav["sort_by"],
+                           after=nav["after"], before=nav["before"], count_mode=nav["count_mode"])
+
+    # ========== Dashboard ==========
+    # จำนวนตรวจวันนี้ / % รถที่พบปัญหา (จาก rollup รายวัน)
+    total_today, total_with_damage, total_all = dash["counts"]
+
+    percent_damage = round((total_with_damage / total_all * 100), 1) if total_all else 0
+
+    # ✅ แปลงวันที่สำหรับแสดงผล
+    today_text = datetime.now().strftime("%d/%m/%Y")
+
+    return render_template("index_page.html",
     total_today=total_today,
     percent_damage=percent_damage,
-    top_issues=top_issues,
     today_text=today_text,   # ✅ ใช้ตัวนี้
-    trend_labels=trend_labels,
-    trend_counts=trend_counts                               
-                              
+    **records_page_context(dash["recs"], dash["total"], **nav),
+    **dashboard_panels_context(dash)
 )
 
+def parse_index_args(args):
+    """หน้า/การเรียง/cursor ของตาราง records จาก query string (หน้า index และ fragment ใช้ร่วมกัน)"""
+    return {
+        "page": int(args.get("page", 1)),
+        "per_page": int(args.get("per_page", 20)),   # 👈 ค่า default = 20
+        "sort_by": args.get("sort_by", "created"),
+        "count_mode": args.get("count", "exact"),
+        "after": decode_cursor(args.get("after")),
+        "before": decode_cursor(args.get("before")),
+    }
+
+def records_page_context(recs, total, page, per_page, sort_by, count_mode, after=None, before=None):
+    """ตัวแปรของตาราง records + pager + จำนวนทั้งหมด"""
+    total_capped = count_mode == "approx" and total is not None and total > COUNT_APPROX_CAP
+    if total_capped:
+        total = COUNT_APPROX_CAP
+
+    if total is None:
+        # ไม่ได้นับ → รู้แค่ว่าหน้านี้เต็มหรือไม่
+        total_pages = page + 1 if len(recs) == per_page else page
+    else:
+        total_pages = (total + per_page - 1) // per_page  # ปัดเศษขึ้น
+
+    return {
+        "recs": recs,
+        "total": total,
+        "total_capped": total_capped,
+        "page": page,
+        "total_pages": total_pages,
+        "page_links": page_window(page, total_pages),
+        "sort_by": sort_by,
+        # cursor ของปุ่ม Previous/Next (keyset: ไม่ต้อง OFFSET ย้อนไปนับแถวก่อนหน้า)
+        "next_cursor": encode_cursor(recs[-1], sort_by) if recs else None,
+        "prev_cursor": encode_cursor(recs[0], sort_by) if recs and page > 2 else None,
+    }
+
+def dashboard_panels_context(dash):
+    """ข้อมูลกราฟ Top 10 / Trend / Top 5 ปัญหา (ทุกตัวผูก filter)"""
+    return {
+        # ========== Chart: Top 10 damaged machines ==========
+        "labels": [r[0] for r in dash["top_damaged"]],
+        "counts": [r[1] for r in dash["top_damaged"]],
+        # ========== Trend (30 วันล่าสุด) ==========
+        "trend_labels": [row[0] for row in dash["trend"]],
+        "trend_counts": [row[1] for row in dash["trend"]],
+        # Top 5 ปัญหาที่พบบ่อย (ผูก filter ค้นหา/ช่วงวันที่)
+        "top_issues": dash["top_issues"],
+    }
+
+# -------------------- Fragments --------------------
+# หน้า index เปลี่ยน filter/sort/หน้า โดยไม่ reload: ส่งกลับเฉพาะ HTML ที่ต้อง swap + ข้อมูลกราฟ (JSON)
+# /fragments/records   = sort / เปลี่ยนหน้า → query หน้าเดียวของตาราง (จำนวนทั้งหมดมาจาก cache)
+# /fragments/dashboard = filter เปลี่ยน (ช่วงวันที่, คลิก Trend, คลิก Top 5) → ตาราง + กราฟ
+def render_records_fragment(ctx):
+    return {
+        "rows": render_template("index_records_rows.html", **ctx),
+        "pager": render_template("index_pager.html", **ctx),
+        "total": render_template("index_total.html", **ctx),
+        "summary": render_template("index_filter_summary.html"),
+        "exports": render_template("index_export_buttons.html"),
+    }
+
+@app.route("/fragments/records")
+@login_required
+def fragment_records():
+    flt = RecordFilter.from_args(request.args)
+    nav = parse_index_args(request.args)
+    with read_snapshot():
+        recs, total = get_records(flt, nav["page"], nav["per_page"], sort_by=nav["sort_by"],
+                                  after=nav["after"], before=nav["before"], count_mode=nav["count_mode"])
+    return render_records_fragment(records_page_context(recs, total, **nav))
+
+@app.route("/fragments/dashboard")
+@login_required
+def fragment_dashboard():
+    flt = RecordFilter.from_args(request.args)
+    nav = parse_index_args(request.args)
+    dash = query_dashboard(flt, nav["page"], nav["per_page"], sort_by=nav["sort_by"],
+                           after=nav["after"], before=nav["before"], count_mode=nav["count_mode"])
+    panels = dashboard_panels_context(dash)
+    body = render_records_fragment(records_page_context(dash["recs"], dash["total"], **nav))
+    body.update(
+        top_issues=render_template("index_top_issues.html", **panels),
+        damage_chart={"labels": panels["labels"], "counts": panels["counts"]},
+        trend_chart={"labels": panels["trend_labels"], "counts": panels["trend_counts"]},
+    )
+    return body
+
 # -------------------- search --------------------
-def get_records(search=None, start_date=None, end_date=None,
-                damage_only=False, page=1, per_page=20,
-                date_filter=None, damage_filter=None):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+# คอลัมน์ของ records ตามลำดับที่โค้ดอ้างด้วยตำแหน่ง (r[0]..r[11]) — SELECT * ใช้ไม่ได้:
+# ลำดับจริงขึ้นกับที่มาของตาราง (schema.sql วาง file_path ก่อน created_by, migration 011 ต่อท้ายด้วย ALTER)
+RECORD_COLUMNS = ("id, machine_no, name, date_text, date_iso, comments, damage, created_by, created_at_iso,"
+                  " file_path, attachment_count, attachment_bytes")
+
+# sort_by → (key ที่ใช้เรียง, ตำแหน่งคอลัมน์ใน RECORD_COLUMNS, ทิศทาง); ใช้ id เป็นตัวตัดสินเมื่อค่าเท่ากัน (keyset ต้องเรียงแบบไม่ซ้ำ)
+# คอลัมน์เป็น NULL ได้ และ (NULL, id) < (?, ?) ไม่เคยจริง → เรียง/เทียบด้วย IFNULL(คอลัมน์, '') (index จาก migration 012)
+SORT_OPTIONS = {
+    "created": ("IFNULL(created_at_iso, '')", 8, "DESC"),
+    "date":    ("IFNULL(date_iso, '')",       4, "DESC"),
+    "machine": ("IFNULL(machine_no, '')",     1, "ASC"),
+}
+COUNT_APPROX_CAP = 10000   # count_mode="approx": นับไม่เกินเท่านี้ แล้วแสดงเป็น "10000+"
 
-    sql = "SELECT * FROM records WHERE 1=1"
-    params = []
+def encode_cursor(row, sort_by):
+    """สร้าง cursor (ค่าคอลัมน์ที่ใช้เรียง, id) ของแถว สำหรับ keyset pagination"""
+    _, pos, _ = SORT_OPTIONS.get(sort_by, SORT_OPTIONS["created"])
+    return make_cursor(row[pos] if row[pos] is not None else "", row[0])
+
+def make_cursor(value, rec_id):
+    raw = json.dumps([value, rec_id], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(token):
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        value, rec_id = json.loads(raw.decode("utf-8"))
+        return (value if value is not None else ""), int(rec_id)
+    except (ValueError, TypeError):
+        return None   # cursor เสีย/ถูกแก้ → กลับไปใช้ page ปกติ
+
+@cached_query
+def get_records(flt, page=1, per_page=20,
+                sort_by="created", after=None, before=None, count_mode="exact", columns=None):
+    """
+    flt: RecordFilter
+    after/before: cursor จาก decode_cursor() → keyset pagination (ไม่ใช้ OFFSET, ทุกหน้าเร็วเท่าหน้าแรก)
+    count_mode: "exact" = COUNT(*), "approx" = นับไม่เกิน COUNT_APPROX_CAP+1, "none" = ไม่นับ (total=None)
+    columns: tuple ชื่อคอลัมน์ที่จะ SELECT (ต้องมาจาก whitelist เท่านั้น); None = RECORD_COLUMNS
+    """
+    conn = get_db()
+    c = conn.cursor()
 
-    # ค้นหาด้วยข้อความ
-    if search:
-        sql += " AND (machine_no LIKE ? OR name LIKE ? OR comments LIKE ? OR damage LIKE ?)"
-        like = f"%{search}%"
-        params += [like, like, like, like]
-
-    # ช่วงวันที่
-    if start_date:
-        sql += " AND date_iso >= ?"
-        params.append(start_date)
-    if end_date:
-        sql += " AND date_iso <= ?"
-        params.append(end_date)
-
-    # เฉพาะที่มีปัญหา
-    if damage_only:
-        sql += " AND damage IS NOT NULL AND damage != ''"
-
-    # ✅ filter จาก Trend Chart
-    if date_filter:
-        sql += " AND date_iso = ?"
-        params.append(date_filter)
-
-    # ✅ filter จาก Top 5 ปัญหา
-    if damage_filter:
-        sql += " AND damage LIKE ?"
-        params.append(f"%{damage_filter}%")
+    where, params = flt.where()
 
     # นับทั้งหมด
-    c.execute(sql, params)
-    total = len(c.fetchall())
+    if count_mode == "none":
+        total = None
+    elif count_mode == "approx":
+        total = c.execute(f"SELECT COUNT(*) FROM (SELECT 1 FROM records{where} LIMIT ?)",
+                          params + [COUNT_APPROX_CAP + 1]).fetchone()[0]
+    else:
+        total = count_records(flt)
 
-    sort_by = request.args.get("sort_by", "created")
+    col, _, direction = SORT_OPTIONS.get(sort_by, SORT_OPTIONS["created"])  # fallback = ล่าสุด
+
+    # ✅ Keyset: ต่อจากแถวสุดท้าย (after) หรือย้อนจากแถวแรก (before) ของหน้าที่แล้ว
+    cursor = after or before
+    backwards = before is not None and after is None
+    if cursor:
+        op = "<" if (direction == "DESC") != backwards else ">"
+        # = ({col}, id) {op} (?, ?) แต่เขียนแยก → SQLite ใช้ expression index เป็นช่วง (row value กับ expression ได้แค่ SCAN)
+        where += f" AND {col} {op}= ? AND ({col} {op} ? OR id {op} ?)"
+        params += [cursor[0], cursor[0], cursor[1]]
+    if backwards:
+        direction = "ASC" if direction == "DESC" else "DESC"
 
     # ✅ Order by ก่อน
-    if sort_by == "created":
-        sql += " ORDER BY created_at_iso DESC"
-    elif sort_by == "date":
-        sql += " ORDER BY date_iso DESC"
-    elif sort_by == "machine":
-        sql += " ORDER BY machine_no ASC"
-    else:
-        sql += " ORDER BY created_at_iso DESC"  # fallback
+    select = ", ".join(columns) if columns else RECORD_COLUMNS
+    sql = f"SELECT {select} FROM records{where} ORDER BY {col} {direction}, id {direction}"
 
     # ✅ Limit/Offset ตาม pagination
-    sql += " LIMIT ? OFFSET ?"
-    params += [per_page, (page - 1) * per_page]
+    if cursor:
+        sql += " LIMIT ?"
+        params.append(per_page)
+    else:
+        sql += " LIMIT ? OFFSET ?"
+        params += [per_page, (page - 1) * per_page]
 
     c.execute(sql, params)
     recs = c.fetchall()
-    conn.close()
+    if backwards:
+        recs.reverse()
     return recs, total
 
+# -------------------- JSON API --------------------
+# API สำหรับ BI script: อ่านอย่างเดียว, filter/sort ชุดเดียวกับหน้า index, keyset pagination
+# fields= เลือกคอลัมน์ → SELECT เฉพาะคอลัมน์นั้น; ETag ผูกกับ data_version → ข้อมูลไม่เปลี่ยนได้ 304 โดยไม่ query
+# ชื่อ field ใน API → คอลัมน์ในตาราง records
+API_FIELDS = {
+    "id": "id", "machine_no": "machine_no", "name": "name",
+    "date": "date_text", "date_iso": "date_iso",
+    "comments": "comments", "damage": "damage",
+    "created_by": "created_by", "created_at": "created_at_iso",
+    # ชื่อไฟล์แนบ (stored_name → /uploads/<ชื่อ>) ต่อด้วย ';' ตามลำดับที่แนบ; ไล่ผ่าน idx_attachments_record
+    "files": "(SELECT group_concat(stored_name, ';') FROM attachments WHERE record_id = records.id)",
+    "attachment_count": "attachment_count", "attachment_bytes": "attachment_bytes",
+}
+API_DEFAULT_LIMIT = 100
+API_MAX_LIMIT = 1000
+
+def api_login_required(view):
+    # API ตอบ 401 เป็น JSON แทนการ redirect ไปหน้า login
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if "user_id" not in session:
+            return {"error": "Login required"}, 401
+        return view(*args, **kwargs)
+    return wrapped
+
+def parse_api_fields(raw):
+    """?fields=a,b → list ชื่อ field (ลำดับตามที่ขอ); ไม่ส่งมา = ทุก field; มีชื่อแปลก → ValueError"""
+    if not raw:
+        return list(API_FIELDS)
+    fields = list(dict.fromkeys(f.strip() for f in raw.split(",") if f.strip()))
+    unknown = [f for f in fields if f not in API_FIELDS]
+    if unknown or not fields:
+        raise ValueError(unknown)
+    return fields
+
+def api_record(row, fields):
+    rec = dict(zip(fields, row))
+    if "files" in rec:
+        rec["files"] = rec["files"].split(";") if rec["files"] else []
+    return rec
+
+def api_conditional(*parts):
+    """
+    ETag ของ response = data_version + request ที่ขอ
+    คืน (etag, response 304 หรือ None) → ถ้าได้ 304 ให้ตอบกลับทันทีไม่ต้อง query
+    """
+    raw = json.dumps([get_data_version(), *parts], ensure_ascii=False).encode("utf-8")
+    etag = hashlib.sha256(raw).hexdigest()[:32]
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "private, no-cache"
+        return etag, resp
+    return etag, None
+
+def api_response(body, etag):
+    resp = app.response_class(json.dumps(body, ensure_ascii=False), mimetype="application/json")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+@app.route("/api/records")
+@api_login_required
+def api_records():
+    """
+    ?fields=id,machine_no,... &limit=100 &after=<cursor> &sort_by=created|date|machine &count=none|approx|exact
+    + filter เดียวกับหน้า index (search, start_date, end_date, damage_only, date_iso, damage_word)
+    """
+    try:
+        fields = parse_api_fields(request.args.get("fields"))
+    except ValueError:
+        return {"error": "Unknown field", "allowed": list(API_FIELDS)}, 400
+    flt = RecordFilter.from_args(request.args)
+    sort_by = request.args.get("sort_by", "created")
+    if sort_by not in SORT_OPTIONS:
+        sort_by = "created"
+    limit = max(1, min(request.args.get("limit", API_DEFAULT_LIMIT, type=int) or API_DEFAULT_LIMIT,
+                       API_MAX_LIMIT))
+    count_mode = request.args.get("count", "none")
+    if count_mode not in ("exact", "approx", "none"):
+        count_mode = "none"
+    after = decode_cursor(request.args.get("after"))
+
+    etag, not_modified = api_conditional("records", fields, asdict(flt), sort_by, limit, count_mode, after)
+    if not_modified:
+        return not_modified
+
+    # SELECT เฉพาะ field ที่ขอ + (id, คอลัมน์ที่ใช้เรียง) ท้ายสุดไว้ทำ cursor ของหน้าถัดไป
+    sort_col = SORT_OPTIONS[sort_by][0]
+    columns = tuple(API_FIELDS[f] for f in fields) + ("id", sort_col)
+    recs, total = get_records(flt, 1, limit, sort_by=sort_by, after=after,
+                              count_mode=count_mode, columns=columns)
+    n = len(fields)
+    body = {
+        "data": [api_record(r[:n], fields) for r in recs],
+        "next_cursor": make_cursor(recs[-1][n + 1], recs[-1][n]) if len(recs) == limit else None,
+        "total": total,
+        "total_capped": count_mode == "approx" and total is not None and total > COUNT_APPROX_CAP,
+    }
+    return api_response(body, etag)
+
+@app.route("/api/records/<int:record_id>")
+@api_login_required
+def api_record_detail(record_id):
+    try:
+        fields = parse_api_fields(request.args.get("fields"))
+    except ValueError:
+        return {"error": "Unknown field", "allowed": list(API_FIELDS)}, 400
+
+    etag, not_modified = api_conditional("record", record_id, fields)
+    if not_modified:
+        return not_modified
 
+    columns = ", ".join(API_FIELDS[f] for f in fields)
+    with get_db() as conn:
+        row = conn.execute(f"SELECT {columns} FROM records WHERE id=?", (record_id,)).fetchone()
+    if not row:
+        return {"error": "Record not found"}, 404
+    return api_response({"data": api_record(row, fields)}, etag)
 
 
 # -------------------- Export --------------------
+EXPORT_BATCH_SIZE = 1000
+# คอลัมน์ของไฟล์ export: (หัวคอลัมน์, ตำแหน่งใน RECORD_COLUMNS) — ไม่รวม date_iso / file_path
+EXPORT_COLUMNS = [
+    ("ID", 0), ("รถ", 1), ("ผู้ตรวจ", 2), ("วันที่", 3),
+    ("หมายเหตุ", 5), ("ชำรุด", 6), ("ผู้บันทึก", 7), ("เวลา", 8),
+]
+
+def iter_record_batches(flt, sort_by="created", batch_size=EXPORT_BATCH_SIZE, progress=None):
+    """
+    ไล่ records ที่ตรง filter ทีละ batch จาก cursor เดียว (ไม่โหลดทั้งหมดเข้า memory)
+    ใช้ connection แยกของตัวเองใน read transaction เดียว → ข้อมูลทั้งไฟล์มาจาก snapshot เดียวกัน
+    progress(จำนวนแถวที่ดึงแล้ว) ถูกเรียกทุก batch (งาน export เบื้องหลังใช้รายงานความคืบหน้า)
+    """
+    col, _, direction = SORT_OPTIONS.get(sort_by, SORT_OPTIONS["created"])
+    where, params = flt.where()
+    conn = _connect()
+    try:
+        conn.execute("BEGIN")
+        cur = conn.execute(
+            f"SELECT {RECORD_COLUMNS} FROM records{where} ORDER BY {col} {direction}, id {direction}", params)
+        done = 0
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            done += len(rows)
+            if progress:
+                progress(done)
+            yield rows
+    finally:
+        conn.close()
+
 # =========================
 # Export Excel
 # =========================
 
-@app.route("/export/excel")
-@login_required
-def export_excel():
-    # ดึงค่า filter จาก query string
-    search = request.args.get("search")
-    start_date = request.args.get("start_date")
-    end_date = request.args.get("end_date")
-    damage_only = bool(request.args.get("damage_only"))
-    
-    # ถ้ามี filter ใช้ filter นั้น → ถ้าไม่มีเลย ให้ดึงทั้งหมด
-    recs, _ = get_records(search, start_date, end_date, damage_only, 1, 99999)
-
-    df = pd.DataFrame(recs, columns=[
-        "ID","รถ","ผู้ตรวจ","วันที่","Date ISO","หมายเหตุ","ชำรุด","ผู้บันทึก","เวลา","ไฟล์"
-    ])
-    df = df.drop(columns=["Date ISO","ไฟล์"])
-    fp = os.path.join(BASE_DIR,"records.xlsx")
-    df.to_excel(fp, index=False)
-    return send_file(fp, as_attachment=True)
+EXCEL_MAX_ROWS = 1048576   # จำกัดของ Excel ต่อ sheet (รวมแถวหัวตาราง)
+XLSX_SPOOL_BYTES = 16 * 1024 * 1024   # ไฟล์เล็กกว่านี้อยู่ใน memory, ใหญ่กว่านี้ spill ลง temp file
 
+def write_xlsx(fileobj, flt, sort_by="created", rows_per_sheet=EXCEL_MAX_ROWS - 1, progress=None):
+    """
+    เขียน workbook แบบ write-only (openpyxl ไม่เก็บ cell ทั้งไฟล์ไว้ใน memory)
+    ครบ rows_per_sheet แถวแล้วขึ้น sheet ใหม่ (Sheet2, Sheet3, ...) พร้อมหัวตาราง
+    """
+    wb = Workbook(write_only=True)
+    bold = Font(bold=True)
+
+    def new_sheet(n):
+        ws = wb.create_sheet(title=f"Sheet{n}")
+        header = []
+        for h, _ in EXPORT_COLUMNS:
+            cell = WriteOnlyCell(ws, value=h)
+            cell.font = bold
+            header.append(cell)
+        ws.append(header)
+        return ws
+
+    sheet_no = 1
+    ws = new_sheet(sheet_no)
+    rows_in_sheet = 0
+    for rows in iter_record_batches(flt, sort_by, progress=progress):
+        for r in rows:
+            if rows_in_sheet >= rows_per_sheet:
+                sheet_no += 1
+                ws = new_sheet(sheet_no)
+                rows_in_sheet = 0
+            ws.append([r[i] for _, i in EXPORT_COLUMNS])
+            rows_in_sheet += 1
+    wb.save(fileobj)
 
 # =========================
 # Export CSV
 # =========================
-@app.route("/export/csv")
-@login_required
-def export_csv():
-    search = request.args.get("search")
-    start_date = request.args.get("start_date")
-    end_date = request.args.get("end_date")
-    damage_only = bool(request.args.get("damage_only"))
+def write_csv(fileobj, flt, sort_by="created", progress=None):
+    # BOM ครั้งเดียวตอนต้นไฟล์ → Excel เปิดภาษาไทยได้ถูก (เหมือน utf-8-sig เดิม)
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow([h for h, _ in EXPORT_COLUMNS])
+    fileobj.write(("\ufeff" + buf.getvalue()).encode("utf-8"))
+    for rows in iter_record_batches(flt, sort_by, progress=progress):
+        buf.seek(0)
+        buf.truncate()
+        writer.writerows([r[i] for _, i in EXPORT_COLUMNS] for r in rows)
+        fileobj.write(buf.getvalue().encode("utf-8"))
+
+# =========================
+# Export PDF
+# =========================
+# ฟอนต์ / styles / โลโก้ / ตารางแบ่งหน้า อยู่ใน pdf_reports (ใช้ร่วมกับ process ของ sheet pool)
+
+def write_pdf(fileobj, flt, sort_by="created", username="Unknown", progress=None):
+    # ----- ฟอนต์ / styles / โลโก้ (เตรียมไว้ครั้งเดียวต่อ worker) -----
+    res = get_pdf_resources()
+    styles = res.styles
+    BASE_FONT = res.base_font
+
+    # ----- เตรียมเอกสาร + Header -----
+    doc = pdf_document(fileobj)
+    elements = pdf_header_elements(res, username)
+
+    # ----- ตารางข้อมูล (ดึงจาก cursor ทีละ batch, สร้างทีละหน้า) -----
+    cell_style = styles["ThaiNormal"]
+    headers = ["หมายเลขรถ","ผู้ตรวจสอบ","วันที่","ความคิดเห็น","รายการความเสียหาย","ผู้บันทึก","เวลาบันทึก"]
+
+    def table_rows():
+        for rows in iter_record_batches(flt, sort_by, progress=progress):
+            for r in rows:
+                yield [Paragraph(str(r[i] or "-"), cell_style) for i in (1, 2, 3, 5, 6, 7, 8)]
+
+    rows = table_rows()
+    col_widths = [70,70,60,100,100,80,80]
+    elements.append(ChunkedTable(
+        [Paragraph(h, cell_style) for h in headers],
+        rows,
+        col_widths,
+        [
+            ('BACKGROUND', (0,0), (-1,0), colors.HexColor("#0d47a1")),
+            ('TEXTCOLOR',  (0,0), (-1,0), colors.white),
+            ('FONTNAME',   (0,0), (-1,-1), BASE_FONT),
+            ('FONTSIZE',   (0,0), (-1,-1), 12),
+            ('GRID',       (0,0), (-1,-1), 0.25, colors.grey),
+            ('VALIGN',     (0,0), (-1,-1), 'MIDDLE'),
+        ],
+    ))
+    elements.append(Spacer(1, 30))
 
-    recs, _ = get_records(search, start_date, end_date, damage_only, 1, 99999)
+    # ----- ช่องเซ็นชื่อ -----
+    elements += pdf_signature_elements(res)
 
-    df = pd.DataFrame(recs, columns=[
-        "ID","รถ","ผู้ตรวจ","วันที่","Date ISO","หมายเหตุ","ชำรุด","ผู้บันทึก","เวลา","ไฟล์"
-    ])
-    df = df.drop(columns=["ไฟล์","Date ISO"])
-    fp = os.path.join(BASE_DIR,"records.csv")
-    df.to_csv(fp, index=False, encoding="utf-8-sig")
-    return send_file(fp, as_attachment=True)
+    # ----- สร้างไฟล์พร้อมเลขหน้า -----
+    try:
+        doc.build(elements, canvasmaker=NumberedCanvas)
+    finally:
+        rows.close()   # ปิด cursor/connection ของ export แม้ build ล้มกลางทาง
 
 # =========================
-# Export PDF
+# Export ใบตรวจรายคัน (ZIP, render ใน process pool)
 # =========================
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib import colors
+# reportlab เป็น pure Python → render ใน thread ของ worker จะแย่ง GIL กับทุก request
+# ใบตรวจแต่ละใบเป็นงานอิสระ → ส่งไป render ใน process แยก แล้ว thread ของ request แค่รอผลและเขียน ZIP
+PDF_SHEET_WORKERS = min(4, os.cpu_count() or 1)
+PDF_SHEET_IN_FLIGHT = PDF_SHEET_WORKERS * 2      # ส่งงานล่วงหน้าไม่เกินนี้ → memory คงที่แม้ records เยอะ
+
+_sheet_pool = None
+_sheet_pool_pid = None
+_sheet_pool_lock = threading.Lock()
+
+def get_sheet_pool():
+    # spawn: ไม่ fork จาก worker ที่มีหลาย thread (lock ที่ค้างอยู่จะติดไปด้วย) และใช้ได้บน Windows
+    # งานที่ส่งเข้า pool (render_inspection_sheet) อยู่ใน pdf_reports → process ลูก import แค่โมดูลนั้น
+    global _sheet_pool, _sheet_pool_pid
+    with _sheet_pool_lock:
+        if _sheet_pool is None or _sheet_pool_pid != os.getpid():
+            _sheet_pool = ProcessPoolExecutor(max_workers=PDF_SHEET_WORKERS,
+                                              mp_context=multiprocessing.get_context("spawn"))
+            _sheet_pool_pid = os.getpid()
+        return _sheet_pool
+
+def inspection_sheet_name(record):
+    return secure_filename(f"{record[0]}_{record[1] or ''}_{record[4] or ''}.pdf") or f"{record[0]}.pdf"
+
+def iter_inspection_sheets(flt, sort_by, username):
+    """(ชื่อไฟล์, bytes ของ PDF) ตามลำดับ records; render พร้อมกันหลาย process"""
+    pool = get_sheet_pool()
+    pending = deque()
+    try:
+        for rows in iter_record_batches(flt, sort_by):
+            files = rows_attachments([r[0] for r in rows if r[10]])
+            for r in rows:
+                pending.append((inspection_sheet_name(r),
+                                pool.submit(render_inspection_sheet, r, username, files.get(r[0], ()))))
+                if len(pending) >= PDF_SHEET_IN_FLIGHT:
+                    name, future = pending.popleft()
+                    yield name, future.result()
+        while pending:
+            name, future = pending.popleft()
+            yield name, future.result()
+    finally:
+        for _, future in pending:   # client ตัดการเชื่อมต่อ → ไม่ต้อง render ใบที่เหลือ
+            future.cancel()
+
+class ZipStream:
+    """
+    ปลายทางของ zipfile ที่ไม่ seek ได้ (zipfile จะเขียน data descriptor ต่อท้ายแต่ละไฟล์แทน)
+    เก็บ bytes ที่ถูกเขียนไว้จน drain() → ส่งต่อเป็น chunk ของ response ได้ทันที
+    """
 
-@app.route("/export/pdf")
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+ZIP_CHUNK_SIZE = 1024 * 1024
+# ไฟล์ที่บีบอัดมาแล้ว → เก็บแบบ stored (บีบซ้ำเปลือง CPU แต่ไม่เล็กลง)
+ZIP_STORED_EXTS = {"jpg", "jpeg", "png", "gif", "pdf", "docx", "xlsx", "zip"}
+
+def iter_zip(entries, compress_type=zipfile.ZIP_DEFLATED):
+    """
+    entries: (ชื่อในไฟล์ zip, bytes หรือ path ของไฟล์บนดิสก์)
+    yield ไฟล์ zip ทีละส่วน ไม่ต้องมีทั้งไฟล์ใน memory/ดิสก์; ไฟล์บนดิสก์อ่านทีละ ZIP_CHUNK_SIZE
+    """
+    out = ZipStream()
+    stamp = datetime.now().timetuple()[:6]
+    with zipfile.ZipFile(out, "w") as zf:
+        for name, source in entries:
+            info = zipfile.ZipInfo(name, date_time=stamp)
+            info.compress_type = compress_type
+            if isinstance(source, bytes):
+                zf.writestr(info, source)
+                yield out.drain()
+                continue
+            try:
+                f = open(source, "rb")
+            except OSError:
+                continue   # ไฟล์หายจากดิสก์ → ข้าม
+            with f:
+                if name.rsplit(".", 1)[-1].lower() in ZIP_STORED_EXTS:
+                    info.compress_type = zipfile.ZIP_STORED
+                info.file_size = os.fstat(f.fileno()).st_size   # ให้ zipfile ตัดสินใจใช้ zip64 เอง
+                with zf.open(info, "w") as dst:
+                    while True:
+                        chunk = f.read(ZIP_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                        yield out.drain()
+            yield out.drain()
+    yield out.drain()
+
+@app.route("/export/sheets")
 @login_required
-def export_pdf():
-    search = request.args.get("search")
-    start_date = request.args.get("start_date")
-    end_date = request.args.get("end_date")
-    damage_only = bool(request.args.get("damage_only"))
+def export_sheets():
+    flt = RecordFilter.from_args(request.args)
+    sort_by = request.args.get("sort_by", "created")
+    username = session.get("username", "Unknown")
+    sheets = iter_inspection_sheets(flt, sort_by, username)
+    return Response(stream_with_context(iter_zip(sheets)), mimetype="application/zip",
+                    headers={"Content-Disposition": "attachment; filename=inspection_sheets.zip"})
+
+# =========================
+# ไฟล์แนบเป็น ZIP (ราย record / ตาม filter)
+# =========================
+def record_attachment_entries(record, files):
+    """(ชื่อในไฟล์ zip, path) ของไฟล์แนบของ record เดียว; จัดเป็นโฟลเดอร์ละ record ไม่ให้ชื่อชนกัน"""
+    folder = secure_filename(f"{record[0]}_{record[1] or ''}_{record[4] or ''}") or str(record[0])
+    seen = set()
+    for stored_name, path, name in files:
+        if name in seen:   # ชื่อเดิมซ้ำกันใน record เดียว → ใช้ชื่อที่เก็บ (ไม่ซ้ำแน่นอน)
+            name = stored_name
+        seen.add(name)
+        yield f"{folder}/{name}", path
+
+def iter_attachment_entries(flt, sort_by="created"):
+    for rows in iter_record_batches(flt, sort_by):
+        files = rows_attachments([r[0] for r in rows if r[10]])
+        for r in rows:
+            if r[0] in files:
+                yield from record_attachment_entries(r, files[r[0]])
+
+def zip_response(entries, filename):
+    return Response(stream_with_context(iter_zip(entries)), mimetype="application/zip",
+                    headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+@app.route("/records/<int:record_id>/attachments.zip")
+@login_required
+def record_attachments_zip(record_id):
+    with get_db() as conn:
+        rec = conn.execute(f"SELECT {RECORD_COLUMNS} FROM records WHERE id=?", (record_id,)).fetchone()
+        if not rec:
+            return {"error": "Record not found"}, 404
+        files = record_attachments(record_id, conn)
+    return zip_response(record_attachment_entries(rec, files), f"record_{record_id}_attachments.zip")
+
+@app.route("/export/attachments")
+@login_required
+def export_attachments():
+    # ไฟล์แนบของทุก record ตาม filter ปัจจุบัน (เช่น รูปทั้งเดือนสำหรับ audit)
+    flt = RecordFilter.from_args(request.args)
+    sort_by = request.args.get("sort_by", "created")
+    return zip_response(iter_attachment_entries(flt, sort_by), "attachments.zip")
 
-    recs, _ = get_records(search, start_date, end_date, damage_only, 1, 99999)
+# =========================
+# Export jobs (เบื้องหลัง)
+# =========================
+# /export/* แค่ลงคิวงานแล้ว redirect ไป /exports/<job_id> → worker ของ gunicorn ไม่ถูกกินยาวจนหมด timeout
+# งานรันใน thread pool จำกัดขนาดของแต่ละ process; สถานะอยู่ในตาราง export_jobs (ทุก process เห็นเหมือนกัน)
+EXPORT_JOB_WORKERS = 2                      # export พร้อมกันได้กี่งานต่อ process
+EXPORT_JOB_MAX_PENDING = 20                 # งานที่รอ/กำลังทำรวมทุก process เกินนี้ → ปฏิเสธงานใหม่
+EXPORT_JOB_MAX_AGE = 24 * 3600              # ไฟล์ผลลัพธ์เก็บไว้กี่วินาที
+EXPORT_JOB_STALE_AFTER = 6 * 3600           # งาน queued/running ที่ค้างนานกว่านี้ถือว่าตายแล้ว (กัน pid ถูกใช้ซ้ำ)
+EXPORT_JOB_DEAD_ERROR = "worker ที่ทำงานนี้หยุดทำงาน โปรด export ใหม่"
+EXPORT_DIR_MAX_BYTES = 1024 * 1024 * 1024   # ขนาดรวมของ EXPORT_DIR; เกินแล้วลบไฟล์ที่ไม่ได้ใช้นานสุดก่อน
+
+# kind → (นามสกุลไฟล์, ชื่อไฟล์ตอนดาวน์โหลด, mimetype)
+EXPORT_FORMATS = {
+    "excel": ("xlsx", "records.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "csv":   ("csv", "records.csv", "text/csv"),
+    "pdf":   ("pdf", "records.pdf", "application/pdf"),
+}
+
+_export_executor = None
+_export_executor_pid = None
+_export_executor_lock = threading.Lock()
+
+def get_export_executor():
+    # สร้างใหม่หลัง fork (thread ของ process แม่ไม่ตามมาด้วย)
+    global _export_executor, _export_executor_pid
+    with _export_executor_lock:
+        if _export_executor is None or _export_executor_pid != os.getpid():
+            _export_executor = ThreadPoolExecutor(max_workers=EXPORT_JOB_WORKERS,
+                                                  thread_name_prefix="export")
+            _export_executor_pid = os.getpid()
+        return _export_executor
+
+def export_cache_key(kind, flt, sort_by, username, data_version):
+    """
+    key ของไฟล์ export: format + filter (normalise แล้ว) + data_version
+    PDF มีชื่อผู้ใช้และวันที่พิมพ์อยู่บนหัวกระดาษ → ต้องอยู่ใน key ด้วย
+    """
+    parts = {
+        "kind": kind,
+        "filter": asdict(flt),
+        "sort_by": sort_by if sort_by in SORT_OPTIONS else "created",
+        "data_version": data_version,
+    }
+    if kind == "pdf":
+        parts["user"] = username
+        parts["printed"] = datetime.now().strftime("%Y-%m-%d")
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()[:32]
+
+def export_artifact_name(name, kind):
+    return f"{name}.{EXPORT_FORMATS[kind][0]}"
 
-    fp = os.path.join(BASE_DIR, "records.pdf")
+def _update_export_job(job_id, **fields):
+    cols = ", ".join(f"{k}=?" for k in fields)
+    with get_db() as conn:
+        conn.execute(f"UPDATE export_jobs SET {cols} WHERE id=?", (*fields.values(), job_id))
 
-    # ----- ฟอนต์ไทย ปลอดภัย + fallback -----
-    font_path = os.path.join("static", "fonts", "THSarabunNew.ttf")
-    BASE_FONT = "Helvetica"
+def _pid_alive(pid):
     try:
-        if os.path.exists(font_path):
-            pdfmetrics.registerFont(TTFont("THSarabunNew", font_path))
-            BASE_FONT = "THSarabunNew"
-    except Exception:
-        BASE_FONT = "Helvetica"   # กันพังไว้ก่อน
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _export_job_dead(pid, created_at, now):
+    """worker ที่รับงานตาย/ถูก restart (max_requests) ไปก่อนทำเสร็จ หรืองานค้างนานเกิน EXPORT_JOB_STALE_AFTER"""
+    if created_at < now - EXPORT_JOB_STALE_AFTER:
+        return True
+    return pid != os.getpid() and (pid is None or not _pid_alive(pid))
+
+def fail_dead_export_jobs(conn):
+    """งาน queued/running ที่ไม่มีใครทำต่อแล้ว → error (ไม่งั้นถูกนับเป็นคิวค้างตลอดไป จนคิวเต็ม)"""
+    now = time.time()
+    rows = conn.execute("SELECT id, pid, created_at FROM export_jobs WHERE status IN ('queued', 'running')")
+    dead = [(EXPORT_JOB_DEAD_ERROR, now, job_id)
+            for job_id, pid, created_at in rows.fetchall() if _export_job_dead(pid, created_at, now)]
+    conn.executemany("""UPDATE export_jobs SET status='error', error=?, finished_at=?
+                        WHERE id=? AND status IN ('queued', 'running')""", dead)
+
+def evict_export_artifacts():
+    """ลบไฟล์ export ที่อายุเกิน EXPORT_JOB_MAX_AGE แล้วลบไฟล์เก่าสุดจนขนาดรวมไม่เกิน EXPORT_DIR_MAX_BYTES"""
+    cutoff = time.time() - EXPORT_JOB_MAX_AGE
+    with get_db() as conn:
+        fail_dead_export_jobs(conn)   # งานค้างของ worker ที่ตายแล้ว → error ก่อน จะได้ถูกลบในรอบนี้ด้วย
+        conn.execute("DELETE FROM export_jobs WHERE created_at < ? AND status NOT IN ('queued', 'running')",
+                     (cutoff,))
+    files = []
+    for entry in os.scandir(EXPORT_DIR):
+        if not entry.is_file():
+            continue
+        st = entry.stat()
+        if st.st_mtime < cutoff:
+            try: os.remove(entry.path)
+            except OSError: pass
+        elif not entry.name.endswith(".part"):   # ไฟล์ที่กำลังเขียนอยู่ไม่นับ/ไม่ลบ
+            files.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= EXPORT_DIR_MAX_BYTES:
+            break
+        try: os.remove(path)
+        except OSError: pass
+        total -= size
+
+def enqueue_export(kind, flt, sort_by, username):
+    """
+    ลงคิวงาน export; คืน job_id หรือ None ถ้าคิวเต็ม
+    ถ้ามีไฟล์ของ key เดียวกัน (ข้อมูลไม่เปลี่ยนตั้งแต่ export ครั้งก่อน) → งานเสร็จทันที ไม่ต้องสร้างใหม่
+    """
+    evict_export_artifacts()
+    job_id = secrets.token_urlsafe(12)
+    data_version = get_data_version()
+    cache_key = export_cache_key(kind, flt, sort_by, username, data_version)
+    cached = export_artifact_name(cache_key, kind)
+    cached_path = os.path.join(EXPORT_DIR, cached)
+    if os.path.exists(cached_path):
+        os.utime(cached_path)   # LRU: ไฟล์ที่ถูกใช้ล่าสุดถูกลบทีหลัง
+        with get_db() as conn:
+            conn.execute("""INSERT INTO export_jobs(id, kind, params, status, file_size, created_by, pid,
+                                                    created_at, finished_at, cache_key, artifact)
+                            VALUES (?,?,?,?,?,?,?,?,?,?,?)""",
+                         (job_id, kind, "{}", "done", os.path.getsize(cached_path), username,
+                          os.getpid(), time.time(), time.time(), cache_key, cached))
+        return job_id
+
+    params = json.dumps({"filter": asdict(flt), "sort_by": sort_by, "data_version": data_version},
+                        ensure_ascii=False)
+    with get_db() as conn:
+        fail_dead_export_jobs(conn)   # นับเฉพาะงานที่ยังมี worker ทำอยู่จริง
+        pending = conn.execute(
+            "SELECT COUNT(*) FROM export_jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+        if pending >= EXPORT_JOB_MAX_PENDING:
+            return None
+        conn.execute("""INSERT INTO export_jobs(id, kind, params, status, created_by, pid, created_at, cache_key)
+                        VALUES (?,?,?,?,?,?,?,?)""",
+                     (job_id, kind, params, "queued", username, os.getpid(), time.time(), cache_key))
+    get_export_executor().submit(run_export_job, job_id)
+    return job_id
+
+def run_export_job(job_id):
+    with get_db() as conn:
+        row = conn.execute("SELECT kind, params, created_by, cache_key FROM export_jobs WHERE id=?",
+                           (job_id,)).fetchone()
+    if not row:
+        return   # ถูกลบไปแล้ว (เช่น restore DB ระหว่างรอคิว)
+    kind, params, username, cache_key = row
+    params = json.loads(params)
+    flt = RecordFilter(**params["filter"])
+    sort_by = params["sort_by"]
+
+    tmp_path = os.path.join(EXPORT_DIR, export_artifact_name(job_id, kind) + ".part")
+    try:
+        _update_export_job(job_id, status="running", total=count_records(flt))
+        progress = lambda done: _update_export_job(job_id, progress=done)
+        with open(tmp_path, "wb") as f:
+            if kind == "excel":
+                write_xlsx(f, flt, sort_by, progress=progress)
+            elif kind == "csv":
+                write_csv(f, flt, sort_by, progress=progress)
+            else:
+                write_pdf(f, flt, sort_by, username=username or "Unknown", progress=progress)
+        # data_version ไม่ขยับระหว่าง export → ไฟล์นี้ตรงกับ key → เก็บเป็น cache ให้คนถัดไปใช้ซ้ำ
+        # ขยับแล้ว → ไม่รู้ว่าได้ข้อมูลของเวอร์ชันไหน ใช้กับงานนี้งานเดียว
+        if get_data_version() == params["data_version"]:
+            artifact = export_artifact_name(cache_key, kind)
+        else:
+            artifact = export_artifact_name(job_id, kind)
+        path = os.path.join(EXPORT_DIR, artifact)
+        os.replace(tmp_path, path)   # ไฟล์โผล่ให้ดาวน์โหลดเมื่อเขียนครบแล้วเท่านั้น
+        _update_export_job(job_id, status="done", file_size=os.path.getsize(path),
+                           finished_at=time.time(), artifact=artifact)
+    except Exception as e:
+        app.logger.exception("Export job %s (%s) ล้มเหลว", job_id, kind)
+        try: os.remove(tmp_path)
+        except OSError: pass
+        _update_export_job(job_id, status="error", error=str(e), finished_at=time.time())
 
-    # ----- Styles -----
-    styles = getSampleStyleSheet()
-    styles.add(ParagraphStyle(name="ThaiNormal", fontName=BASE_FONT, fontSize=12, leading=14))
-    styles.add(ParagraphStyle(name="ThaiHeader", fontName=BASE_FONT, fontSize=16, alignment=1, spaceAfter=10))
+def _enqueue_export_response(kind):
+    flt = RecordFilter.from_args(request.args)
+    sort_by = request.args.get("sort_by", "created")
+    job_id = enqueue_export(kind, flt, sort_by, session.get("username", "Unknown"))
+    if job_id is None:
+        flash("⚠️ มีงาน export รอคิวอยู่มาก โปรดลองใหม่อีกสักครู่", "warning")
+        return redirect(url_for("index", **request.args))
+    return redirect(url_for("export_job", job_id=job_id))
 
-    # ----- เตรียมเอกสาร -----
-    doc = SimpleDocTemplate(
-        fp, pagesize=A4, rightMargin=30, leftMargin=30, topMargin=40, bottomMargin=30
-    )
-    elements = []
-
-    # ----- Header + โลโก้ (ไม่บังคับให้มีไฟล์) -----
-    logo_path = os.path.join("static", "logo.png")
-    if os.path.exists(logo_path):
-        elements.append(Image(logo_path, width=250, height=60))
-
-    user = session.get("username", "Unknown")
-    elements.append(Paragraph("<b>แบบตรวจยานพาหนะก่อนใช้งาน</b>", styles["ThaiHeader"]))
-    elements.append(Paragraph("Vehicle Pre-Use Check", styles["ThaiHeader"]))
-    elements.append(Paragraph("โลตัสฮอลวิศวกรรมเหมืองแร่และก่อสร้าง จำกัด", styles["ThaiNormal"]))
-    elements.append(Paragraph("LotusHall Mining : Heavy Engineering Construction Co., Ltd.", styles["ThaiNormal"]))
-    elements.append(Paragraph(
-        "วันที่พิมพ์รายงาน : " + datetime.now().strftime("%d/%m/%Y") + f" (ผู้ใช้: {user})",
-        styles["ThaiNormal"]
-    ))
-    elements.append(Spacer(1, 12))
+@app.route("/export/excel")
+@login_required
+def export_excel():
+    return _enqueue_export_response("excel")
 
-    # ----- ตารางข้อมูล -----
-    headers = ["หมายเลขรถ","ผู้ตรวจสอบ","วันที่","ความคิดเห็น","รายการความเสียหาย","ผู้บันทึก","เวลาบันทึก"]
-    data = [[Paragraph(h, styles["ThaiNormal"]) for h in headers]]
-    for r in recs:
-        data.append([
-            Paragraph(str(r[1] or "-"), styles["ThaiNormal"]),
-            Paragraph(str(r[2] or "-"), styles["ThaiNormal"]),
-            Paragraph(str(r[3] or "-"), styles["ThaiNormal"]),
-            Paragraph(str(r[5] or "-"), styles["ThaiNormal"]),
-            Paragraph(str(r[6] or "-"), styles["ThaiNormal"]),
-            Paragraph(str(r[7] or "-"), styles["ThaiNormal"]),
-            Paragraph(str(r[8] or "-"), styles["ThaiNormal"]),
-        ])
+@app.route("/export/csv")
+@login_required
+def export_csv():
+    return _enqueue_export_response("csv")
 
-    col_widths = [70,70,60,100,100,80,80]
-    table = Table(data, repeatRows=1, colWidths=col_widths)
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0,0), (-1,0), colors.HexColor("#0d47a1")),
-        ('TEXTCOLOR',  (0,0), (-1,0), colors.white),
-        ('FONTNAME',   (0,0), (-1,-1), BASE_FONT),
-        ('FONTSIZE',   (0,0), (-1,-1), 12),
-        ('GRID',       (0,0), (-1,-1), 0.25, colors.grey),
-        ('VALIGN',     (0,0), (-1,-1), 'MIDDLE'),
-        ('ROWBACKGROUNDS', (0,1), (-1,-1), [colors.whitesmoke, colors.lightgrey]),
-    ]))
-    elements.append(table)
-    elements.append(Spacer(1, 30))
+@app.route("/export/pdf")
+@login_required
+def export_pdf():
+    return _enqueue_export_response("pdf")
 
-    # ----- ช่องเซ็นชื่อ -----
-    elements.append(Paragraph("ผู้ตรวจสอบ .................................................", styles["ThaiNormal"]))
-    elements.append(Spacer(1, 20))
-    elements.append(Paragraph("วันที่ ............................................................", styles["ThaiNormal"]))
+register_template("export_job.html", """{% include "theme.html" %}
+    <div class="container-narrow mt-4">
+      <div class="card card-body shadow-sm">
+        <h5 class="mb-3">📦 กำลังเตรียมไฟล์ {{ filename }}</h5>
+        <div class="progress mb-2" style="height: 1.4rem;">
+          <div id="jobBar" class="progress-bar progress-bar-striped progress-bar-animated"
+               style="width: {{ job.percent }}%">{{ job.percent }}%</div>
+        </div>
+        <div id="jobText" class="text-muted small mb-3">{{ job.progress }} / {{ job.total if job.total is not none else '…' }} รายการ</div>
+        <div id="jobDone" class="alert alert-success d-none">
+          ✅ ไฟล์พร้อมแล้ว — ถ้าไม่ดาวน์โหลดอัตโนมัติ <a id="jobLink" href="{{ job.download_url or '#' }}">คลิกที่นี่</a>
+        </div>
+        <div id="jobError" class="alert alert-danger d-none"></div>
+        <a href="{{url_for('index')}}" class="btn btn-secondary">⬅ กลับหน้าหลัก</a>
+      </div>
+    </div>
+    <script>
+    (function () {
+      const statusUrl = {{ url_for('export_job', job_id=job.job_id, format='json')|tojson }};
+      function show(job) {
+        const bar = document.getElementById("jobBar");
+        bar.style.width = job.percent + "%";
+        bar.textContent = job.percent + "%";
+        document.getElementById("jobText").textContent =
+          job.progress + " / " + (job.total === null ? "…" : job.total) + " รายการ";
+        if (job.status === "done") {
+          bar.classList.remove("progress-bar-animated");
+          document.getElementById("jobLink").href = job.download_url;
+          document.getElementById("jobDone").classList.remove("d-none");
+          window.location = job.download_url;
+          return;
+        }
+        if (job.status === "error" || job.status === "expired") {
+          bar.classList.add("bg-danger");
+          const box = document.getElementById("jobError");
+          box.textContent = job.status === "error" ? "❌ สร้างไฟล์ไม่สำเร็จ: " + job.error : "⌛ ไฟล์หมดอายุแล้ว โปรด export ใหม่";
+          box.classList.remove("d-none");
+          return;
+        }
+        setTimeout(poll, 1000);
+      }
+      function poll() {
+        fetch(statusUrl, {credentials: "same-origin"}).then(r => r.json()).then(show)
+          .catch(() => setTimeout(poll, 3000));
+      }
+      show({{ job|tojson }});
+    })();
+    </script>
+    """)
 
-    # ----- สร้างไฟล์พร้อมเลขหน้า -----
-    doc.build(elements, canvasmaker=NumberedCanvas)
+@app.route("/exports/<job_id>")
+@login_required
+def export_job(job_id):
+    """
+    สถานะงาน export: ?format=json → JSON (หน้า progress poll ทุกวินาที)
+    งานเสร็จแล้ว → ส่งไฟล์; ยังไม่เสร็จ → หน้า progress
+    """
+    with get_db() as conn:
+        row = conn.execute("""SELECT kind, status, progress, total, error, created_by, pid,
+                                     created_at, cache_key, artifact
+                              FROM export_jobs WHERE id=?""", (job_id,)).fetchone()
+    if not row:
+        return {"error": "Export job not found"}, 404
+    kind, status, progress, total, error, created_by, pid, created_at, cache_key, artifact = row
+    if created_by != session.get("username") and session.get("role") != "admin":
+        return "⛔ ไม่มีสิทธิ์", 403
 
-    return send_file(fp, as_attachment=True)
+    if status in ("queued", "running") and _export_job_dead(pid, created_at, time.time()):
+        status, error = "error", EXPORT_JOB_DEAD_ERROR
+        _update_export_job(job_id, status=status, error=error, finished_at=time.time())
+    path = os.path.join(EXPORT_DIR, artifact) if artifact else None
+    if status == "done" and (not path or not os.path.exists(path)):
+        status = "expired"   # artifact ถูก evict ไปแล้ว หรือไม่เคยถูกบันทึก (artifact เป็น NULL)
+
+    ext, filename, mimetype = EXPORT_FORMATS[kind]
+    job = {
+        "job_id": job_id, "kind": kind, "status": status, "progress": progress, "total": total,
+        "percent": 100 if status == "done" else (min(99, progress * 100 // total) if total else 0),
+        "error": error,
+        "download_url": url_for("export_job", job_id=job_id) if status == "done" else None,
+    }
+    if request.args.get("format") == "json":
+        return job
+    if status == "done":
+        # ไฟล์จาก cache: ETag = key (เนื้อหาเดียวกันเสมอ) → browser ที่มีอยู่แล้วได้ 304
+        os.utime(path)
+        etag = cache_key if artifact == export_artifact_name(cache_key, kind) else True
+        return send_file(path, as_attachment=True, download_name=filename, mimetype=mimetype,
+                         etag=etag, max_age=0)
+    if status == "expired":
+        return render_template("export_job.html", job=job, filename=filename), 410
+    return render_template("export_job.html", job=job, filename=filename)
 
 
     #RESTORE DATABASE
@@ -1926,6 +3845,22 @@ def _validate_uploaded_db_file(db_path):
 
 
 
+register_template("restore_db.html", """{% include "theme.html" %}
+    <div class="container-narrow mt-3">
+      <h4>🗂️ Restore Database</h4>
+      <form method="post" enctype="multipart/form-data" class="card card-body shadow-sm">
+        <label for="dbfile">เลือกไฟล์ .db เพื่อ restore:</label>
+        <input type="file" name="dbfile" id="dbfile" accept=".db" class="form-control" required>
+        <p class="text-muted small mt-2">
+          ระบบจะตรวจสุขภาพไฟล์และสำรองไฟล์เดิมไว้เป็น <code>.bak_YYYYMMDD_HHMMSS</code>
+        </p>
+        <button class="btn btn-danger mt-3"
+          onclick="return confirm('พิมพ์ OK เพื่อยืนยัน') && prompt('พิมพ์ OK เพื่อยืนยัน')==='OK'">♻️ Restore</button>
+        <a href="{{url_for('index')}}" class="btn btn-secondary mt-2">⬅ กลับหน้าหลัก</a>
+      </form>
+    </div>
+    """)
+
 @app.route("/restore_db", methods=["GET","POST"])
 @login_required
 def restore_db():
@@ -1961,15 +3896,31 @@ def restore_db():
 
         # สลับไฟล์แบบอะตอมมิก + ตั้ง permission
         try:
+            prev_version = get_data_version() if os.path.exists(DB_NAME) else 0
             if os.path.exists(DB_NAME):
+                checkpoint_db()
+                invalidate_db_pool()
                 backup_path = DB_NAME + f".bak_{ts}"
                 os.replace(DB_NAME, backup_path)
+                # -wal/-shm ของไฟล์เดิมห้ามติดไปกับไฟล์ใหม่ → ย้ายตามไปเป็นชุดเดียวกับ backup (ไม่ลบ)
+                # connection ของ worker อื่นที่ยังไม่รู้ตัวจะเห็นไฟล์ชุดเดิมครบ จนกว่า get_db() จะเปิดใหม่
+                for suffix in ("-wal", "-shm"):
+                    try: os.replace(DB_NAME + suffix, backup_path + suffix)
+                    except FileNotFoundError: pass
 
             os.replace(tmp_path, DB_NAME)
 
             try: os.chmod(DB_NAME, 0o644)
             except: pass
 
+            # backup เก่าอาจมาจาก schema เวอร์ชันก่อน → อัปเกรดให้ทันที
+            init_db()
+            # data_version ของไฟล์ที่ restore อาจซ้ำกับค่าที่ worker อื่น cache ไว้ → ดันให้ใหม่กว่าเสมอ
+            with get_db() as conn:
+                conn.execute("UPDATE app_meta SET value = MAX(value, ?) + 1 WHERE key = 'data_version'",
+                             (prev_version,))
+            query_cache.clear()
+
             flash("✅ Restore สำเร็จ (สำรองไฟล์เดิมเป็น .bak_เวลาแล้ว)", "success")
             return redirect(url_for("index"))
         except Exception as e:
@@ -1980,25 +3931,10 @@ def restore_db():
             return redirect(url_for("restore_db"))
 
     # GET form
-    return render_template_string(THEME_CSS + """
-    <div class="container-narrow mt-3">
-      <h4>🗂️ Restore Database</h4>
-      <form method="post" enctype="multipart/form-data" class="card card-body shadow-sm">
-        <label for="dbfile">เลือกไฟล์ .db เพื่อ restore:</label>
-        <input type="file" name="dbfile" id="dbfile" accept=".db" class="form-control" required>
-        <p class="text-muted small mt-2">
-          ระบบจะตรวจสุขภาพไฟล์และสำรองไฟล์เดิมไว้เป็น <code>.bak_YYYYMMDD_HHMMSS</code>
-        </p>
-        <button class="btn btn-danger mt-3"
-          onclick="return confirm('พิมพ์ OK เพื่อยืนยัน') && prompt('พิมพ์ OK เพื่อยืนยัน')==='OK'">♻️ Restore</button>
-        <a href="{{url_for('index')}}" class="btn btn-secondary mt-2">⬅ กลับหน้าหลัก</a>
-      </form>
-    </div>
-    """)
+    return render_template("restore_db.html")
 
 
 
-import stat
 def ensure_db_permissions():
     try:
         if os.path.exists(DB_NAME):
@@ -2016,10 +3952,11 @@ def __db_health():
     try:
         if not info["exists"]:
             return info, 200
-        with sqlite3.connect(DB_NAME) as conn:
+        with get_db() as conn:
             c = conn.cursor()
             c.execute("PRAGMA integrity_check;")
             info["integrity"] = c.fetchone()[0]
+            info["journal_mode"] = c.execute("PRAGMA journal_mode").fetchone()[0]
             c.execute("SELECT name FROM sqlite_master WHERE type='table'")
             info["tables"] = [r[0] for r in c.fetchall()]
             # อาจล้มถ้าขาดตาราง => จะเข้า except ด้านล่าง พร้อม error
@@ -2027,6 +3964,8 @@ def __db_health():
             info["records_count"] = c.fetchone()[0]
             c.execute("SELECT COUNT(*) FROM users WHERE username='admin'")
             info["has_admin"] = c.fetchone()[0] > 0
+            info["data_version"] = get_data_version(conn)
+        info["query_cache"] = query_cache.stats()
         return info, 200
     except Exception as e:
         info["error"] = f"{type(e).__name__}: {e}"
@@ -2035,6 +3974,21 @@ def __db_health():
 
 
 
+# -------------------- Template loader --------------------
+def install_template_loader():
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    env = app.jinja_env
+    env.loader = ChoiceLoader([DictLoader(INLINE_TEMPLATES), env.loader])
+    # bytecode cache บนดิสก์: worker ถัดไป/restart ไม่ต้อง compile ซ้ำ
+    env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+    # compile ล่วงหน้าตอน boot → request แรกไม่ต้องรอ
+    for name in INLINE_TEMPLATES:
+        env.get_template(name)
+
+if not POOL_CHILD:
+    install_template_loader()
+
+
 # -------------------- Run --------------------
 if __name__=="__main__":
     init_db()
@@ -0,0 +1,37 @@
+# bench_pdf_pages.py
+# -*- coding: utf-8 -*-
+# ตรวจหน่วยความจำของ NumberedCanvas: สร้าง PDF หลายพันหน้า แล้วเทียบ peak RSS กับเพดานที่กำหนด
+# (worker บน production มี RAM 512 MB)
+# ใช้: python bench_pdf_pages.py [จำนวนหน้า=2000] [เพดาน MB=64]
+# exit code 1 ถ้าใช้ memory เกินเพดาน
+import io, os, sys, tempfile, time, resource
+
+# ใช้ HOME ชั่วคราว → ไม่แตะ DB จริงใน ~/Yui_App_DB
+os.environ["HOME"] = tempfile.mkdtemp()
+from reportlab.lib.pagesizes import A4
+import app_interactive_header_filters_patched as m
+
+PAGES = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+CEILING_MB = float(sys.argv[2]) if len(sys.argv) > 2 else 64
+
+def rss_mb():
+    # ru_maxrss หน่วยเป็น KB บน Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+base = rss_mb()
+t = time.time()
+buf = io.BytesIO()
+c = m.NumberedCanvas(buf, pagesize=A4)
+for page in range(PAGES):
+    # เนื้อหาประมาณหนึ่งหน้าของตาราง export (~60 แถว)
+    for row in range(60):
+        c.drawString(40, 800 - row * 12, f"{page:05d}-{row:02d} " + "x" * 60)
+    c.showPage()
+c.save()
+used = rss_mb() - base
+
+print(f"pages      : {PAGES}")
+print(f"pdf size   : {len(buf.getvalue()) / 1e6:.2f} MB")
+print(f"time       : {time.time() - t:.1f} s")
+print(f"peak RSS + : {used:.1f} MB (ceiling {CEILING_MB:.0f} MB)")
+sys.exit(0 if used <= CEILING_MB else 1)
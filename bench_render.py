@@ -0,0 +1,32 @@
+# bench_render.py
+# -*- coding: utf-8 -*-
+# Micro-benchmark: เวลา render ต่อ request ของ template หน้า index
+#   ก่อน = render_template_string (parse + compile ใหม่ทุกครั้ง)
+#   หลัง = render_template ผ่าน DictLoader (compile ครั้งเดียว แล้ว cache)
+# ใช้: python bench_render.py [จำนวนรอบ]
+import os, sys, tempfile, timeit
+
+# ใช้ HOME ชั่วคราว → ไม่แตะ DB จริงใน ~/Yui_App_DB
+os.environ["HOME"] = tempfile.mkdtemp()
+from flask import render_template, render_template_string
+import app_interactive_header_filters_patched as m
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+source = m.INLINE_TEMPLATES["index_page.html"]
+ctx = dict(
+    recs=[(i, f"M{i}", "n", "25/09/01", "2025-09-01", "c", "x y", "admin", "2025-09-01 08:00:00", None)
+          for i in range(20)],
+    total=20, page=1, total_pages=1, page_links=[1], total_capped=False, sort_by="created",
+    next_cursor=None, prev_cursor=None, labels=[], counts=[], total_today=0, percent_damage=0,
+    top_issues=[], today_text="01/09/2025", trend_labels=[], trend_counts=[],
+)
+
+with m.app.test_request_context("/"):
+    m.session.update({"user_id": 1, "username": "admin", "role": "admin"})
+    before = timeit.timeit(lambda: render_template_string(source, **ctx), number=N) / N
+    render_template("index_page.html", **ctx)   # warm
+    after = timeit.timeit(lambda: render_template("index_page.html", **ctx), number=N) / N
+
+print(f"render_template_string : {before * 1000:8.2f} ms/request")
+print(f"render_template (cache): {after * 1000:8.2f} ms/request")
+print(f"speed-up               : {before / after:8.1f}x")
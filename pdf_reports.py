@@ -0,0 +1,280 @@
+# pdf_reports.py
+# -*- coding: utf-8 -*-
+# ส่วนสร้าง PDF ที่ไม่แตะ Flask / DB: ฟอนต์, หัวกระดาษ, ตารางแบ่งหน้า, ใบตรวจรายคัน
+# process ของ sheet pool (spawn) import แค่ไฟล์นี้ → ไม่ต้อง import แอปทั้งก้อน (init_db, migration, template)
+# ห้ามมีงานตอน import นอกจากประกาศค่าคงที่
+import copy, io, logging, os, threading
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+from PIL import Image as PILImage
+from reportlab import rl_config
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import mm
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image, Flowable
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")   # = app.static_folder
+
+
+class NumberedCanvas(canvas.Canvas):
+    """
+    เลขหน้า "หน้า/ทั้งหมด" มุมขวาล่าง
+    ทุกหน้าอ้างถึง form XObject ของเลขหน้าไว้ก่อน แล้วค่อยวาดเนื้อหา form ตอน save() เมื่อรู้จำนวนหน้า
+    → ไม่ต้องเก็บ state ของ canvas ทุกหน้าไว้ใน memory (เดิม copy __dict__ ทั้งก้อนทุกหน้า)
+    """
+
+    def showPage(self):
+        # form ยังไม่ต้องมีตอนนี้ ขอแค่ถูกสร้างก่อน save
+        self.doForm(self._page_number_form(self._pageNumber))
+        super().showPage()
+
+    def save(self):
+        # วาดเลขหน้าของทุกหน้าลง form ของหน้านั้น แล้วค่อยบันทึก
+        if len(self._code):
+            self.showPage()
+        num_pages = self._pageNumber - 1
+        for page in range(1, num_pages + 1):
+            self.beginForm(self._page_number_form(page))
+            self._draw_page_number(page, num_pages)
+            self.endForm()
+        super().save()
+
+    @staticmethod
+    def _page_number_form(page):
+        return f"PageNo{page}"
+
+    def _draw_page_number(self, page, page_count):
+        # ฟอนต์ไทยมี/ไม่มี ก็ไม่ให้ล้ม
+        font = get_pdf_resources().base_font
+        self.setFont(font, 12 if font == "THSarabunNew" else 10)
+        self.drawRightString(200*mm, 10*mm, f"{page}/{page_count}")
+
+
+# ----- ทรัพยากร PDF (ฟอนต์ / styles / โลโก้) เตรียมครั้งเดียวต่อ worker process -----
+PDF_FONT_PATH = os.path.join(STATIC_DIR, "fonts", "THSarabunNew.ttf")   # absolute → ไม่ขึ้นกับ cwd
+PDF_LOGO_PATH = os.path.join(STATIC_DIR, "logo.png")
+PDF_LOGO_SIZE = (250, 60)
+
+@dataclass(frozen=True)
+class PdfResources:
+    base_font: str
+    styles: object              # StyleSheet1 รวม ThaiNormal / ThaiHeader
+    logo: Optional[Image]       # ต้นแบบที่ decode รูปแล้ว (ใช้ผ่าน logo_flowable())
+
+    def logo_flowable(self):
+        # copy ตื้นต่อเอกสาร: ใช้รูปที่ decode แล้วร่วมกัน แต่ไม่แชร์ state ตอนวาด (canv) ข้าม thread
+        return copy.copy(self.logo) if self.logo is not None else None
+
+_pdf_resources = None
+_pdf_resources_lock = threading.Lock()
+
+def _load_pdf_resources():
+    # stream ใน PDF (โลโก้, ฟอนต์ฝัง) เก็บเป็น binary ตรง ๆ ไม่ต้องแปลง ASCII85 ทุกครั้งที่ export
+    # (ตัวแปลงของ reportlab เป็น pure Python → ช้าที่สุดในการสร้าง PDF สั้น ๆ)
+    rl_config.useA85 = 0
+
+    base_font = "Helvetica"
+    try:
+        if os.path.exists(PDF_FONT_PATH):
+            pdfmetrics.registerFont(TTFont("THSarabunNew", PDF_FONT_PATH))
+            base_font = "THSarabunNew"
+        else:
+            logger.warning("ไม่พบฟอนต์ไทย %s → ใช้ Helvetica", PDF_FONT_PATH)
+    except Exception:
+        logger.exception("ลงทะเบียนฟอนต์ไทยไม่สำเร็จ → ใช้ Helvetica")
+
+    styles = getSampleStyleSheet()
+    styles.add(ParagraphStyle(name="ThaiNormal", fontName=base_font, fontSize=12, leading=14))
+    styles.add(ParagraphStyle(name="ThaiHeader", fontName=base_font, fontSize=16, alignment=1, spaceAfter=10))
+    styles.add(ParagraphStyle(name="ThaiLabel", parent=styles["ThaiNormal"], textColor=colors.white))
+
+    logo = None
+    if os.path.exists(PDF_LOGO_PATH):
+        with open(PDF_LOGO_PATH, "rb") as f:
+            logo = Image(io.BytesIO(f.read()), width=PDF_LOGO_SIZE[0], height=PDF_LOGO_SIZE[1])
+        logo._img.getRGBData()   # decode ตอนนี้เลย แทนที่จะ decode ใหม่ทุกครั้งที่ export
+    return PdfResources(base_font, styles, logo)
+
+def get_pdf_resources():
+    global _pdf_resources
+    if _pdf_resources is None:
+        with _pdf_resources_lock:
+            if _pdf_resources is None:
+                _pdf_resources = _load_pdf_resources()
+    return _pdf_resources
+
+PDF_ZEBRA = [colors.whitesmoke, colors.lightgrey]
+PDF_CELL_PAD_X, PDF_CELL_PAD_Y = 6, 3   # padding ค่า default ของ cell ใน reportlab Table
+
+class ChunkedTable(Flowable):
+    """
+    ตารางยาวที่ดึงแถวจาก iterator มาทีละหน้า: วัดความสูงแถวครั้งเดียวตอนดึงมา แล้วตัดเป็น Table ขนาดหนึ่งหน้า
+    (หัวตารางซ้ำทุกหน้า, สีสลับแถวต่อเนื่องข้ามหน้า) แถวที่เหลือกลายเป็น ChunkedTable ก้อนใหม่ขึ้นหน้าถัดไป
+    เดิมเป็น Table ก้อนเดียวทั้งไฟล์ → split แต่ละหน้าต้อง wrap แถวที่เหลือทั้งหมดใหม่ (โตเกิน linear)
+    """
+
+    def __init__(self, header, rows, col_widths, style, pending=None, row_offset=0):
+        super().__init__()
+        self.header = header
+        self.rows = rows                    # iterator ของแถว (list ของ cell)
+        self.col_widths = col_widths
+        self.style = style                  # list ของ TableStyle command (ไม่รวม zebra)
+        self.pending = list(pending or [])  # [(cells, ความสูง)] ที่ดึงมาแล้วแต่ยังไม่ได้วาด
+        self.row_offset = row_offset        # จำนวนแถวที่วาดไปแล้ว → ให้สีสลับแถวต่อกันข้ามหน้า
+        self.header_height = self._row_height(header)
+
+    def _row_height(self, cells):
+        return max(c.wrap(w - 2 * PDF_CELL_PAD_X, 72000)[1]
+                   for c, w in zip(cells, self.col_widths)) + 2 * PDF_CELL_PAD_Y
+
+    def _fit(self, availHeight):
+        """ดึงแถวเพิ่มจนล้น availHeight หรือแถวหมด → (จำนวนแถวที่ลงได้, ความสูง, ล้นไหม)"""
+        used, n = self.header_height, 0
+        while True:
+            if n == len(self.pending):
+                row = next(self.rows, None)
+                if row is None:
+                    return n, used, False
+                self.pending.append((row, self._row_height(row)))
+            h = self.pending[n][1]
+            if used + h > availHeight:
+                return n, used + h, True
+            used += h
+            n += 1
+
+    def _table(self, n):
+        zebra = PDF_ZEBRA if self.row_offset % 2 == 0 else PDF_ZEBRA[::-1]
+        rows = self.pending[:n]
+        table = Table([self.header] + [cells for cells, _ in rows], colWidths=self.col_widths,
+                      rowHeights=[self.header_height] + [h for _, h in rows], repeatRows=1)
+        table.setStyle(TableStyle(self.style + [('ROWBACKGROUNDS', (0,1), (-1,-1), zebra)]))
+        return table
+
+    def wrap(self, availWidth, availHeight):
+        _, self.height, _ = self._fit(availHeight)
+        self.width = sum(self.col_widths)
+        return self.width, self.height
+
+    def split(self, availWidth, availHeight):
+        n, _, overflow = self._fit(availHeight)
+        if not n:
+            return []   # ไม่มีที่แม้แต่แถวเดียว → ให้ขึ้นหน้าใหม่
+        if not overflow:
+            return [self._table(n)]
+        rest = ChunkedTable(self.header, self.rows, self.col_widths, self.style,
+                            pending=self.pending[n:], row_offset=self.row_offset + n)
+        return [self._table(n), rest]
+
+    def draw(self):
+        # ถูกวาดทั้งก้อนก็ต่อเมื่อ wrap แล้วแถวที่เหลือทั้งหมดลงหน้านี้ได้
+        table = self._table(len(self.pending))
+        table.wrapOn(self.canv, self.width, self.height)
+        table.drawOn(self.canv, 0, 0)
+
+def pdf_document(fileobj):
+    return SimpleDocTemplate(
+        fileobj, pagesize=A4, rightMargin=30, leftMargin=30, topMargin=40, bottomMargin=30
+    )
+
+def pdf_header_elements(res, username):
+    """โลโก้ (ไม่บังคับให้มีไฟล์) + หัวกระดาษของรายงาน"""
+    styles = res.styles
+    elements = []
+    logo = res.logo_flowable()
+    if logo is not None:
+        elements.append(logo)
+
+    elements.append(Paragraph("<b>แบบตรวจยานพาหนะก่อนใช้งาน</b>", styles["ThaiHeader"]))
+    elements.append(Paragraph("Vehicle Pre-Use Check", styles["ThaiHeader"]))
+    elements.append(Paragraph("โลตัสฮอลวิศวกรรมเหมืองแร่และก่อสร้าง จำกัด", styles["ThaiNormal"]))
+    elements.append(Paragraph("LotusHall Mining : Heavy Engineering Construction Co., Ltd.", styles["ThaiNormal"]))
+    elements.append(Paragraph(
+        "วันที่พิมพ์รายงาน : " + datetime.now().strftime("%d/%m/%Y") + f" (ผู้ใช้: {username})",
+        styles["ThaiNormal"]
+    ))
+    elements.append(Spacer(1, 12))
+    return elements
+
+def pdf_signature_elements(res):
+    styles = res.styles
+    return [
+        Paragraph("ผู้ตรวจสอบ .................................................", styles["ThaiNormal"]),
+        Spacer(1, 20),
+        Paragraph("วันที่ ............................................................", styles["ThaiNormal"]),
+    ]
+
+
+# ----- ใบตรวจรายคัน (render ใน process ของ sheet pool) -----
+SHEET_IMAGE_EXTS = {"png", "jpg", "jpeg", "gif"}
+SHEET_MAX_THUMBS = 6
+SHEET_THUMB_BOX = (165, 120)                     # กรอบรูปย่อบนกระดาษ (point)
+SHEET_THUMB_PX = 480                             # ย่อรูปก่อนฝัง → PDF ไม่บวมตามรูปต้นฉบับ
+
+SHEET_FIELDS = [
+    ("หมายเลขรถ", 1), ("ผู้ตรวจสอบ", 2), ("วันที่", 3), ("ความคิดเห็น", 5),
+    ("รายการความเสียหาย", 6), ("ผู้บันทึก", 7), ("เวลาบันทึก", 8),
+]
+
+def _sheet_thumbnail(path):
+    with PILImage.open(path) as im:
+        im.thumbnail((SHEET_THUMB_PX, SHEET_THUMB_PX))
+        if im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        buf = io.BytesIO()
+        im.save(buf, "JPEG", quality=80)
+        w, h = im.size
+    scale = min(SHEET_THUMB_BOX[0] / w, SHEET_THUMB_BOX[1] / h)
+    buf.seek(0)
+    return Image(buf, width=w * scale, height=h * scale)
+
+def render_inspection_sheet(record, username, files=()):
+    """ใบตรวจของ record เดียว → bytes ของ PDF (รันใน process ของ pool); files = record_attachments() ของ record"""
+    res = get_pdf_resources()
+    styles = res.styles
+    buf = io.BytesIO()
+    doc = pdf_document(buf)
+    elements = pdf_header_elements(res, username)
+
+    # ----- รายละเอียดการตรวจ -----
+    data = [[Paragraph(h, styles["ThaiLabel"]), Paragraph(str(record[i] or "-"), styles["ThaiNormal"])]
+            for h, i in SHEET_FIELDS]
+    table = Table(data, colWidths=[130, 405])
+    table.setStyle(TableStyle([
+        ('BACKGROUND', (0,0), (0,-1), colors.HexColor("#0d47a1")),
+        ('GRID',       (0,0), (-1,-1), 0.25, colors.grey),
+        ('VALIGN',     (0,0), (-1,-1), 'MIDDLE'),
+        ('ROWBACKGROUNDS', (1,0), (1,-1), PDF_ZEBRA),
+    ]))
+    elements.append(table)
+    elements.append(Spacer(1, 12))
+
+    # ----- ไฟล์แนบ: รูปเป็น thumbnail, ไฟล์อื่นแสดงชื่อ -----
+    thumbs, others = [], []
+    for _, path, name in files:
+        if name.rsplit(".", 1)[-1].lower() in SHEET_IMAGE_EXTS and len(thumbs) < SHEET_MAX_THUMBS:
+            try:
+                thumbs.append(_sheet_thumbnail(path))
+                continue
+            except Exception:
+                pass   # ไฟล์หาย/เสีย → แสดงเป็นชื่อไฟล์แทน
+        others.append(name)
+    if thumbs:
+        elements.append(Paragraph("<b>รูปแนบ</b>", styles["ThaiNormal"]))
+        grid = [thumbs[i:i + 3] for i in range(0, len(thumbs), 3)]
+        grid[-1] += [""] * (3 - len(grid[-1]))
+        elements.append(Table(grid, colWidths=[178] * 3))
+        elements.append(Spacer(1, 6))
+    if others:
+        elements.append(Paragraph("ไฟล์แนบอื่น : " + ", ".join(others), styles["ThaiNormal"]))
+    elements.append(Spacer(1, 30))
+
+    elements += pdf_signature_elements(res)
+    doc.build(elements, canvasmaker=NumberedCanvas)
+    return buf.getvalue()